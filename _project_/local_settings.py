@@ -0,0 +1,6 @@
+SECRET_KEY = 'test'
+DEBUG = True
+ALLOWED_HOSTS = ['*']
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/booktime.sqlite3'}}
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+MIGRATION_MODULES = {'main': None}
@@ -35,6 +35,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.middlewares.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'main.middlewares.basket_middleware',
@@ -120,6 +121,10 @@ CKEDITOR_CONFIGS = {
 
 FORM_RENDERER = 'django.forms.renderers.TemplatesSetting'
 
+# Метрики запросов на /metrics/ и лог медленных запросов
+PROFILING_ENABLED = False
+PROFILING_LATENCY_BUDGET = 0.5
+
 # Логирование
 LOGGING = {
     'version': 1,
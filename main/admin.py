@@ -1,5 +1,7 @@
 from django.contrib import admin
-from django.utils.html import format_html
+from django.db.models import Sum
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
 from . import models
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 
@@ -7,9 +9,10 @@ admin.site.site_header = "Интернет магазин Книг"
 
 
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'slug', 'in_stock', 'price')
-    list_filter = ('active', 'in_stock', 'date_updated')
-    list_editable = ('in_stock', )
+    list_display = ('name', 'slug', 'stock', 'reserved', 'price')
+    list_filter = ('active', 'date_updated')
+    list_editable = ('stock', )
+    readonly_fields = ('reserved',)
     search_fields = ('name',)
     autocomplete_fields = ('tags',)
     prepopulated_fields = {"slug": ("name",)}
@@ -30,6 +33,7 @@ admin.site.register(models.ProductTag, ProductTagAdmin)
 
 class ProductImageAdmin(admin.ModelAdmin):
     list_display = ('thumbnail_tag', 'product_name',)
+    list_select_related = ('product',)
     readonly_fields = ('thumbnail',)
     search_fields = ('product__name',)
 
@@ -84,24 +88,65 @@ class BasketLineInline(admin.TabularInline):
 
 @admin.register(models.Basket)
 class BasketAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "status", "count")
+    list_display = ("id", "user", "status", "items_count", "lines_count")
     list_editable = ("status",)
     list_filter = ("status",)
+    list_select_related = ("user",)
+    readonly_fields = ("items_count", "lines_count")
     inlines = (BasketLineInline,)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.update_counts()
 
-class OrderLineInline(admin.TabularInline):
-    model = models.OrderLine
-    raw_id_fields = ("product",)
+
+ORDER_SUMMARY_FIELDS = (
+    "lines_count",
+    "items_count",
+    "products_count",
+    "new_count",
+    "processing_count",
+    "sent_count",
+    "cancelled_count",
+    "total",
+)
+
+
+def set_line_status(status, description):
+    def action(modeladmin, request, queryset):
+        updated = queryset.set_status(status)
+        modeladmin.message_user(request, "Изменено строк: %d" % updated)
+    action.short_description = description
+    action.__name__ = "set_status_%d" % status
+    return action
 
 
+@admin.register(models.OrderLine)
+class OrderLineAdmin(admin.ModelAdmin):
+    list_display = ("id", "order", "product", "quantity", "unit_price", "line_total", "status")
+    list_filter = ("status",)
+    list_select_related = ("order", "product")
+    list_per_page = 100
+    # без COUNT(*) по всей таблице строк на каждой странице
+    show_full_result_count = False
+    raw_id_fields = ("order", "product")
+    actions = [
+        set_line_status(models.OrderLine.PROCESSING, "Отметить: в обработке"),
+        set_line_status(models.OrderLine.SENT, "Отметить: отправлены"),
+        set_line_status(models.OrderLine.CANCELLED, "Отметить: отменены"),
+    ]
+
+
+@admin.register(models.Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "status")
+    list_display = ("id", "user", "status") + ORDER_SUMMARY_FIELDS[1:] + ("date_added",)
     list_editable = ("status",)
     list_filter = ("status", "shipping_country", "date_added")
-    inlines = (OrderLineInline,)
+    list_select_related = ("user",)
+    readonly_fields = ORDER_SUMMARY_FIELDS + ("lines_summary", "invoice")
     fieldsets = (
-        (None, {"fields": ("user", "status")}),
+        (None, {"fields": ("user", "status", "invoice")}),
+        ("Summary", {"fields": ORDER_SUMMARY_FIELDS + ("lines_summary",)}),
         (
             "Billing info",
             {
@@ -128,4 +173,35 @@ class OrderAdmin(admin.ModelAdmin):
                 )
             },
         ),
-    )
\ No newline at end of file
+    )
+
+    def lines_summary(self, obj):
+        """Строки заказа сгруппированные по товару и статусу, вместо построчного inline"""
+        if not obj.pk:
+            return "-"
+        statuses = dict(models.OrderLine.STATUSES)
+        rows = (
+            obj.lines.values("product__name", "status")
+            .annotate(items=Sum("quantity"))
+            .order_by("product__name", "status")
+        )
+        url = "%s?order__id__exact=%d" % (reverse("admin:main_orderline_changelist"), obj.pk)
+        return format_html(
+            '<table><tr><th>Товар</th><th>Статус</th><th>Количество</th></tr>{}</table>'
+            '<p><a href="{}">Все строки заказа</a></p>',
+            format_html_join(
+                "",
+                "<tr><td>{}</td><td>{}</td><td>{}</td></tr>",
+                ((row["product__name"], statuses[row["status"]], row["items"]) for row in rows),
+            ),
+            url,
+        )
+    lines_summary.short_description = "Строки"
+
+
+@admin.register(models.OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ("id", "subject", "status", "attempts", "send_after", "date_sent")
+    list_filter = ("status",)
+    search_fields = ("subject",)
+    readonly_fields = ("dedupe_key", "attempts", "last_error", "date_sent")
@@ -0,0 +1,159 @@
+"""
+JSON API каталога только для чтения.
+
+GET /api/products/?fields=id,name,price&tag=opensource&cursor=...&limit=50
+GET /api/products/<slug>/
+GET /api/products/<slug>/images/
+GET /api/tags/
+GET /api/export/products.jsonl  - потоковая выгрузка всего каталога
+"""
+import hashlib
+
+from django.core.paginator import InvalidPage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition, require_GET
+
+from main import caching
+from main import models
+from main.pagination import KeysetPaginator
+
+PRODUCT_FIELDS = ("id", "name", "slug", "description", "price", "active", "in_stock", "date_updated", "tags")
+DEFAULT_FIELDS = ("id", "name", "slug", "price", "tags")
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+EXPORT_CHUNK_SIZE = 2000
+# поля-свойства модели и колонки, из которых они вычисляются
+DERIVED_FIELDS = {"in_stock": ("stock", "reserved")}
+
+
+class FieldsError(ValueError):
+    pass
+
+
+def parse_fields(request):
+    fields = request.GET.get("fields")
+    if not fields:
+        return DEFAULT_FIELDS
+    fields = tuple(f.strip() for f in fields.split(",") if f.strip())
+    unknown = set(fields) - set(PRODUCT_FIELDS)
+    if unknown:
+        raise FieldsError("Unknown fields: %s" % ", ".join(sorted(unknown)))
+    return fields
+
+
+def product_queryset(fields, tag=None):
+    products = models.Product.objects.active()
+    if tag:
+        products = products.filter(tags__slug=tag)
+    db_fields = {"id"}
+    for field in fields:
+        if field != "tags":
+            db_fields.update(DERIVED_FIELDS.get(field, (field,)))
+    products = products.only(*db_fields)
+    if "tags" in fields:
+        products = products.prefetch_related("tags")
+    return products
+
+
+def serialize_product(product, fields):
+    data = {}
+    for field in fields:
+        if field == "tags":
+            data["tags"] = [tag.slug for tag in product.tags.all()]
+        else:
+            data[field] = getattr(product, field)
+    return data
+
+
+def catalog_etag(request, *args, **kwargs):
+    """Версия каталога из кэша и параметры запроса, без обращения к базе"""
+    query = hashlib.md5(request.GET.urlencode().encode()).hexdigest()
+    version = caching.get_version(caching.ALL_TAGS)
+    if "in_stock" in request.GET.get("fields", ""):
+        version = "%s-%s" % (version, caching.get_stock_version())
+    return "%s-%s" % (version, query)
+
+
+def product_etag(request, slug):
+    """Дата изменения и наличие: резервы меняют наличие без сохранения товара"""
+    state = models.Product.objects.active().filter(slug=slug).values_list("date_updated", "stock", "reserved").first()
+    if state is None:
+        return None
+    date_updated, stock, reserved = state
+    return "%s-%d" % (date_updated.timestamp(), stock is None or stock > reserved)
+
+
+def product_last_modified(request, slug):
+    return models.Product.objects.active().filter(slug=slug).values_list("date_updated", flat=True).first()
+
+
+@require_GET
+@gzip_page
+@condition(etag_func=catalog_etag)
+def product_list(request):
+    try:
+        fields = parse_fields(request)
+        limit = max(1, min(int(request.GET.get("limit", DEFAULT_LIMIT)), MAX_LIMIT))
+    except (FieldsError, ValueError) as e:
+        return HttpResponseBadRequest(str(e))
+
+    paginator = KeysetPaginator(product_queryset(fields, request.GET.get("tag")), limit, ordering=("id",))
+    try:
+        page = paginator.page(request.GET.get("cursor"))
+    except InvalidPage:
+        raise Http404("Invalid cursor")
+    return JsonResponse({
+        "results": [serialize_product(p, fields) for p in page],
+        "next": page.next_cursor,
+        "previous": page.previous_cursor,
+    })
+
+
+@require_GET
+@gzip_page
+@condition(etag_func=product_etag)
+def product_detail(request, slug):
+    product = get_object_or_404(models.Product.objects.active().prefetch_related("tags"), slug=slug)
+    data = serialize_product(product, PRODUCT_FIELDS)
+    data["images"] = product.image_manifest()
+    return JsonResponse(data)
+
+
+@require_GET
+@gzip_page
+@condition(last_modified_func=product_last_modified)
+def product_images(request, slug):
+    product = get_object_or_404(models.Product.objects.active().only("id", "date_updated"), slug=slug)
+    return JsonResponse(product.image_manifest(), safe=False)
+
+
+@require_GET
+@gzip_page
+@condition(etag_func=catalog_etag)
+def tag_list(request):
+    tags = models.ProductTag.objects.filter(active=True).order_by("name").values("id", "name", "slug", "description")
+    return JsonResponse({"results": list(tags)})
+
+
+@require_GET
+@gzip_page
+@condition(etag_func=catalog_etag)
+def product_export(request):
+    """Весь каталог в JSON Lines, строки сериализуются по мере чтения курсора"""
+    try:
+        fields = parse_fields(request)
+    except FieldsError as e:
+        return HttpResponseBadRequest(str(e))
+    products = product_queryset(fields, request.GET.get("tag")).order_by("id")
+
+    def rows():
+        encoder = DjangoJSONEncoder(ensure_ascii=False)
+        for product in products.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield encoder.encode(serialize_product(product, fields)) + "\n"
+
+    response = StreamingHttpResponse(rows(), content_type="application/x-ndjson; charset=utf-8")
+    response["Content-Disposition"] = 'attachment; filename="products.jsonl"'
+    return response
@@ -6,4 +6,5 @@ class MainConfig(AppConfig):
     verbose_name = 'Меню магазина'
 
     def ready(self):
-        from . import signals
\ No newline at end of file
+        from . import signals, search
+        search.load_index()
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Кэш фрагментов каталога.
+
+Ключи фрагментов включают версию каталога для тэга. Сигналы меняют
+версию только у тэгов затронутого товара (и у общего списка "all"),
+поэтому остальные страницы остаются в кэше. Построение холодного
+ключа выполняет только один запрос, остальные ждут результат.
+Функции с префиксом "a" - то же самое для async-view.
+"""
+import asyncio
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ALL_TAGS = "all"
+LOCK_TIMEOUT = 10
+WAIT_INTERVAL = 0.05
+WAIT_ATTEMPTS = 40
+
+
+STOCK_VERSION_KEY = "catalog-stock-version"
+
+
+def version_key(tag_slug):
+    return "catalog-version:%s" % tag_slug
+
+
+def _get_or_add_version(key, create=True):
+    version = cache.get(key)
+    if version is None and create:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def get_version(tag_slug, create=True):
+    return _get_or_add_version(version_key(tag_slug), create)
+
+
+def get_stock_version():
+    """Версия остатков: резервы и списания меняют наличие без сохранения товара"""
+    return _get_or_add_version(STOCK_VERSION_KEY)
+
+
+def bump_stock_version():
+    cache.set(STOCK_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+async def aget_version(tag_slug, create=True):
+    key = version_key(tag_slug)
+    version = await cache.aget(key)
+    if version is None and create:
+        await cache.aadd(key, uuid.uuid4().hex, None)
+        version = await cache.aget(key)
+    return version
+
+
+def bump_versions(tag_slugs):
+    """Новая версия для тэгов и общего списка товаров"""
+    slugs = set(tag_slugs) | {ALL_TAGS}
+    cache.set_many({version_key(slug): uuid.uuid4().hex for slug in slugs}, None)
+    logger.debug("Обновлены версии каталога для тэгов %s", ", ".join(sorted(slugs)))
+
+
+def get_or_build(key, build, timeout):
+    """Значение из кэша, при промахе строится одним процессом под блокировкой"""
+    value = cache.get(key)
+    metrics.record_cache(value is not None)
+    if value is not None:
+        return value
+
+    lock_key = "lock:%s" % key
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = build()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    for attempt in range(WAIT_ATTEMPTS):
+        time.sleep(WAIT_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    logger.warning("Не дождались построения %s, строим сами", key)
+    return build()
+
+
+async def aget_or_build(key, build, timeout):
+    """get_or_build для корутины build, ожидание не блокирует event loop"""
+    value = await cache.aget(key)
+    metrics.record_cache(value is not None)
+    if value is not None:
+        return value
+
+    lock_key = "lock:%s" % key
+    if await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            value = await build()
+            await cache.aset(key, value, timeout)
+        finally:
+            await cache.adelete(lock_key)
+        return value
+
+    for attempt in range(WAIT_ATTEMPTS):
+        await asyncio.sleep(WAIT_INTERVAL)
+        value = await cache.aget(key)
+        if value is not None:
+            return value
+    logger.warning("Не дождались построения %s, строим сами", key)
+    return await build()
@@ -1,2 +1,8 @@
 class BasketException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class OutOfStock(BasketException):
+    def __init__(self, product):
+        super().__init__("Not enough stock for product id=%s" % product.pk)
+        self.product = product
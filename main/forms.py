@@ -4,8 +4,8 @@ from django import forms
 from django.contrib.auth import authenticate
 from django.contrib.auth.forms import (UserCreationForm as DjangoUserCreationForm)
 from django.contrib.auth.forms import UsernameField
-from django.core.mail import send_mail
-from django.forms import inlineformset_factory
+from django.db import transaction
+from django.forms import BaseInlineFormSet, inlineformset_factory
 
 from . import models, widgets
 
@@ -20,7 +20,7 @@ class ContactForm(forms.Form):
     def send_mail(self):
         logger.info("Отправка электронной почты в службу поддержки клиентов")
         message = "From: {0}\n{1}".format(self.cleaned_data["name"], self.cleaned_data["message"])
-        send_mail("Сообщение с сайта", message, "site@booktime.domain", ["customerservice@booktime.domain"], fail_silently=False)
+        models.OutgoingEmail.objects.enqueue("Сообщение с сайта", message, "site@booktime.domain", ["customerservice@booktime.domain"])
 
 
 class UserCreationForm(DjangoUserCreationForm):
@@ -34,7 +34,13 @@ class UserCreationForm(DjangoUserCreationForm):
         logger.info("Отправка электронной почты для регистрации email=%s", self.cleaned_data["email"])
 
         message = "Добро пожаловать {}".format(self.cleaned_data["email"])
-        send_mail("Добро пожаловать в BookTime", message, "site@booktime.domain", [self.cleaned_data["email"]], fail_silently=True)
+        models.OutgoingEmail.objects.enqueue(
+            "Добро пожаловать в BookTime",
+            message,
+            "site@booktime.domain",
+            [self.cleaned_data["email"]],
+            dedupe_key="signup:%s" % self.cleaned_data["email"],
+        )
 
 
 class AuthenticationForm(forms.Form):
@@ -64,7 +70,36 @@ class AuthenticationForm(forms.Form):
         return self.user
 
 
-BasketLineFormSet = inlineformset_factory(models.Basket, models.BasketLine, fields=("quantity",), extra=0, widgets={"quantity": widgets.PlusMinusNumberInput()})
+class BaseBasketLineFormSet(BaseInlineFormSet):
+    """Строки корзины с пересчетом счетчиков после сохранения"""
+    def __init__(self, *args, queryset=None, **kwargs):
+        # название товара выводится в каждой строке
+        if queryset is None:
+            queryset = models.BasketLine.objects.select_related("product").order_by("id")
+        super().__init__(*args, queryset=queryset, **kwargs)
+
+    def save(self, commit=True):
+        if not commit:
+            return super().save(commit=commit)
+        with transaction.atomic():
+            result = super().save(commit=commit)
+            self.update_holds()
+            self.instance.update_counts()
+        return result
+
+    def update_holds(self):
+        """Резервы по новым количествам строк, OutOfStock при нехватке остатка"""
+        quantities = {}
+        for form in self.forms:
+            line = form.instance
+            if line.product.stock is None or not form.has_changed():
+                continue
+            quantities[line.product] = 0 if form in self.deleted_forms else line.quantity
+        for product in sorted(quantities, key=lambda p: p.pk):
+            models.StockHold.objects.set_quantity(self.instance, product, quantities[product])
+
+
+BasketLineFormSet = inlineformset_factory(models.Basket, models.BasketLine, formset=BaseBasketLineFormSet, fields=("quantity",), extra=0, widgets={"quantity": widgets.PlusMinusNumberInput()})
 
 
 class AddressSelectionForm(forms.Form):
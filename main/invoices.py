@@ -0,0 +1,112 @@
+"""
+Счета заказов в PDF.
+
+HTML счета рендерится шаблоном invoice.html, PDF строит weasyprint
+(необязательная зависимость, импортируется при первом использовании).
+Файл сохраняется по хэшу HTML, поэтому повторная генерация неизменного
+счета не запускает дорогой рендер PDF. Шаблон и статические файлы
+(CSS) кэшируются в процессе и переиспользуются между счетами.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.db.models import Prefetch
+from django.template.loader import get_template
+
+from .models import Order, OrderLine
+
+INVOICE_TEMPLATE = "invoice.html"
+INVOICE_DIR = "invoices"
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _template():
+    return get_template(INVOICE_TEMPLATE)
+
+
+def invoice_lines():
+    return OrderLine.objects.select_related("product").order_by("id")
+
+
+def render_html(order, lines=None):
+    if lines is None:
+        lines = invoice_lines().filter(order=order)
+    return _template().render({"order": order, "lines": lines})
+
+
+def invoice_path(html):
+    digest = hashlib.sha256(html.encode()).hexdigest()
+    return "%s/%s/%s.pdf" % (INVOICE_DIR, digest[:2], digest)
+
+
+@lru_cache(maxsize=64)
+def _static_file(path):
+    found = finders.find(path) or os.path.join(settings.BASE_DIR, "static", path)
+    with open(found, "rb") as f:
+        return f.read()
+
+
+def url_fetcher(url):
+    """Статика читается с диска один раз на процесс, без HTTP-запросов"""
+    prefix = "file://" + settings.STATIC_URL
+    if url.startswith(prefix):
+        path = url[len(prefix):]
+        return {
+            "string": _static_file(path),
+            "mime_type": mimetypes.guess_type(path)[0],
+            "redirected_url": url,
+        }
+    from weasyprint import default_url_fetcher
+    return default_url_fetcher(url)
+
+
+def render_pdf(html):
+    from weasyprint import HTML
+    return HTML(string=html, base_url="file:///", url_fetcher=url_fetcher).write_pdf()
+
+
+def generate_invoice(order):
+    """
+    Счет заказа в хранилище по хэшу содержимого.
+    Возвращает путь и признак, что PDF был построен заново.
+    """
+    html = render_html(order, getattr(order, "_prefetched_objects_cache", {}).get("lines"))
+    path = invoice_path(html)
+    created = not default_storage.exists(path)
+    if created:
+        saved = default_storage.save(path, ContentFile(render_pdf(html)))
+        if saved != path:
+            # параллельный процесс успел записать тот же счет
+            default_storage.delete(saved)
+    return path, created
+
+
+def generate_invoices(order_ids):
+    """Генерация счетов для пачки заказов, вызывается в процессах пула"""
+    close_old_connections()
+    orders = (
+        Order.objects.filter(id__in=order_ids)
+        .prefetch_related(Prefetch("lines", queryset=invoice_lines()))
+        .order_by("id")
+    )
+    changed = []
+    created = 0
+    for order in orders:
+        path, is_new = generate_invoice(order)
+        created += is_new
+        if order.invoice.name != path:
+            order.invoice.name = path
+            changed.append(order)
+    Order.objects.bulk_update(changed, ["invoice"])
+    logger.info("Invoices generated=%d updated=%d for orders=%d", created, len(changed), len(order_ids))
+    return created, len(order_ids) - created
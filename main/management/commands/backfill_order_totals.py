@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum
+
+from main import models
+
+
+class Command(BaseCommand):
+    """
+    Заполнение цен строк и сумм заказов, оформленных до снимка цен,
+    и сводки по строкам (счетчики статусов) заказов, оформленных до нее:
+    python manage.py backfill_order_totals --chunk-size 1000
+
+    Цена исторических заказов неизвестна, берется текущая цена товара.
+    Заказы обрабатываются пачками по id, каждая пачка в своей транзакции,
+    поэтому команду можно прервать и запустить повторно.
+    """
+    SUMMARY_FIELDS = ["lines_count", "items_count", "products_count"] + list(models.OrderLine.STATUS_COUNTERS.values())
+    help = "Backfill order line prices and order totals in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        price = models.Product.objects.filter(pk=OuterRef("product_id")).values("price")[:1]
+        line_total = models.OrderLine.objects.filter(order_id=OuterRef("pk")).values("order_id").annotate(
+            total=Sum("line_total")
+        ).values("total")
+        orders = models.Order.objects.filter(total__isnull=True)
+
+        processed = lines = 0
+        for ids in self.chunks(orders, options["chunk_size"]):
+            with transaction.atomic():
+                lines += models.OrderLine.objects.filter(order_id__in=ids, unit_price__isnull=True).update(
+                    unit_price=Subquery(price),
+                    line_total=ExpressionWrapper(
+                        Subquery(price) * F("quantity"),
+                        output_field=DecimalField(max_digits=10, decimal_places=2),
+                    ),
+                )
+                models.Order.objects.filter(id__in=ids).update(total=Subquery(line_total))
+                # заказы без строк
+                models.Order.objects.filter(id__in=ids, total__isnull=True).update(total=0)
+            processed += len(ids)
+            self.stdout.write("Orders processed=%d" % processed)
+
+        # сводка нулевая у заказов до ее появления, пустые заказы пересчитываются без изменений
+        summaries = 0
+        for ids in self.chunks(models.Order.objects.filter(lines_count=0), options["chunk_size"]):
+            with transaction.atomic():
+                self.update_summaries(ids)
+            summaries += len(ids)
+
+        self.stdout.write("Backfilled orders=%d lines=%d summaries=%d" % (processed, lines, summaries))
+
+    def chunks(self, orders, size):
+        last_id = 0
+        while True:
+            ids = list(orders.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:size])
+            if not ids:
+                return
+            yield ids
+            last_id = ids[-1]
+
+    def update_summaries(self, ids):
+        """Сводка пачки заказов одной группировкой строк и bulk_update"""
+        rows = models.OrderLine.objects.filter(order_id__in=ids).values("order_id").annotate(
+            lines_count=Count("id"),
+            items_count=Sum("quantity"),
+            products_count=Count("product", distinct=True),
+            **{
+                field: Sum("quantity", filter=Q(status=status))
+                for status, field in models.OrderLine.STATUS_COUNTERS.items()
+            }
+        )
+        orders = {order_id: models.Order(pk=order_id) for order_id in ids}
+        for order in orders.values():
+            for field in self.SUMMARY_FIELDS:
+                setattr(order, field, 0)
+        for row in rows:
+            order = orders[row.pop("order_id")]
+            for field, value in row.items():
+                setattr(order, field, value or 0)
+        models.Order.objects.bulk_update(orders.values(), self.SUMMARY_FIELDS)
@@ -0,0 +1,65 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from main import models
+from main.pagination import KeysetPaginator
+
+SEQ_SCAN_PATTERNS = {
+    "postgresql": re.compile(r"Seq Scan on (\w+)"),
+    # SQLite: "SCAN table" без "USING ... INDEX" означает полный просмотр таблицы
+    "sqlite": re.compile(r"\bSCAN (\w+)(?!.*USING (COVERING )?INDEX)(?!.*USING INTEGER PRIMARY KEY)"),
+    "mysql": re.compile(r"\bALL\b"),
+}
+
+
+def hot_queries():
+    """Запросы горячих путей каталога, корзины и заказов"""
+    tag_id = models.ProductTag.objects.values_list("id", flat=True).first() or 0
+    user_id = models.User.objects.values_list("id", flat=True).first() or 0
+    products = models.Product.objects.active().order_by("name", "id")
+    keyset = KeysetPaginator(products, 4).seek(["m", 0], "gt")
+    return [
+        ("product detail by slug", models.Product.objects.filter(slug="cathedral-bazaar")),
+        ("tag by slug", models.ProductTag.objects.filter(slug="opensource")),
+        ("product list", products[:5]),
+        ("product list next page", products.filter(keyset)[:5]),
+        ("product list by tag", products.filter(tags=tag_id)[:5]),
+        ("product images", models.ProductImage.objects.filter(product_id=1)),
+        ("open basket by user", models.Basket.objects.filter(user_id=user_id, status=models.Basket.OPEN)),
+        ("basket lines", models.BasketLine.objects.filter(basket_id=1).select_related("product")),
+        ("order lines by status", models.OrderLine.objects.filter(order_id=1, status=models.OrderLine.NEW)),
+        ("rendition queue", models.RenditionJob.objects.filter(status=models.RenditionJob.NEW).order_by("id")[:50]),
+    ]
+
+
+class Command(BaseCommand):
+    """
+    EXPLAIN для горячих запросов с поиском полных просмотров таблиц, команда:
+    python manage.py explain_queries --verbose
+    """
+    help = "Explain hot queries and flag sequential scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verbose", action="store_true", help="Print full query plans")
+        parser.add_argument("--fail-on-seq-scan", action="store_true")
+
+    def handle(self, *args, **options):
+        pattern = SEQ_SCAN_PATTERNS.get(connection.vendor)
+        flagged = []
+        queries = hot_queries()
+        for name, queryset in queries:
+            plan = queryset.explain()
+            scans = pattern.findall(plan) if pattern else []
+            status = "SEQ SCAN" if scans else "ok"
+            if scans:
+                flagged.append(name)
+            self.stdout.write("%-28s %s" % (name, status))
+            if options["verbose"] or scans:
+                for line in plan.splitlines():
+                    self.stdout.write("    %s" % line)
+
+        self.stdout.write("Queries explained=%d (seq scans=%d)" % (len(queries), len(flagged)))
+        if flagged and options["fail_on_seq_scan"]:
+            raise CommandError("Sequential scans in: %s" % ", ".join(flagged))
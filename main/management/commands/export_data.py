@@ -0,0 +1,122 @@
+import csv
+import json
+import multiprocessing
+import os.path
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Aggregate, CharField, Max, Min, OuterRef, Subquery
+
+from main import models
+
+FIELDNAMES = ["name", "description", "tags", "image_filename", "price"]
+
+
+class TagNames(Aggregate):
+    """Имена тэгов товара через | одним запросом"""
+    function = "GROUP_CONCAT"
+    template = "%(function)s(%(expressions)s, '|')"
+    output_field = CharField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function="STRING_AGG", **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="%(function)s(%(expressions)s SEPARATOR '|')", **extra_context)
+
+
+def export_queryset(id_from=None, id_to=None):
+    first_image = models.ProductImage.objects.filter(product=OuterRef("pk")).order_by("id").values("image")[:1]
+    products = models.Product.objects.all()
+    if id_from is not None:
+        products = products.filter(id__gte=id_from, id__lt=id_to)
+    return (
+        products.order_by("id")
+        .annotate(tag_names=TagNames("tags__name"), image=Subquery(first_image))
+        .values("id", "name", "slug", "description", "price", "tag_names", "image")
+    )
+
+
+def write_rows(path, fmt, chunk_size, id_from=None, id_to=None, header=True):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            if header:
+                writer.writeheader()
+        for row in export_queryset(id_from, id_to).iterator(chunk_size=chunk_size):
+            data = {
+                "name": row["name"],
+                "description": row["description"],
+                "tags": row["tag_names"] or "",
+                "image_filename": os.path.basename(row["image"] or ""),
+                "price": str(row["price"]),
+            }
+            if fmt == "csv":
+                writer.writerow(data)
+            else:
+                data["slug"] = row["slug"]
+                data["tags"] = data["tags"].split("|") if data["tags"] else []
+                data["image"] = row["image"] or ""
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def export_shard(args):
+    """Выгрузка диапазона id в отдельный файл, выполняется в дочернем процессе"""
+    path, fmt, chunk_size, id_from, id_to = args
+    count = write_rows(path, fmt, chunk_size, id_from, id_to, header=False)
+    connections.close_all()
+    return count
+
+
+class Command(BaseCommand):
+    """
+    Выгрузка товаров в формате, который принимает import_data, команда:
+    python manage.py export_data catalog.csv
+    python manage.py export_data catalog.jsonl --format jsonl --shards 4
+    """
+    help = "Export products from BookTime"
+
+    def add_arguments(self, parser):
+        parser.add_argument("outfile", type=str)
+        parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--shards", type=int, default=1, help="Processes exporting id ranges in parallel")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Exporting products")
+        outfile, fmt, chunk_size = options["outfile"], options["format"], options["chunk_size"]
+        if options["shards"] < 1:
+            raise CommandError("--shards must be positive")
+
+        if options["shards"] == 1:
+            count = write_rows(outfile, fmt, chunk_size)
+        else:
+            count = self.export_sharded(outfile, fmt, chunk_size, options["shards"])
+        self.stdout.write("Products exported=%d" % count)
+
+    def export_sharded(self, outfile, fmt, chunk_size, shards):
+        bounds = models.Product.objects.aggregate(low=Min("id"), high=Max("id"))
+        if bounds["low"] is None:
+            return write_rows(outfile, fmt, chunk_size)
+        step = (bounds["high"] - bounds["low"]) // shards + 1
+        jobs = [
+            ("%s.part%d" % (outfile, i), fmt, chunk_size, bounds["low"] + i * step, bounds["low"] + (i + 1) * step)
+            for i in range(shards)
+        ]
+        # дочерние процессы открывают собственные соединения с базой
+        connections.close_all()
+        with multiprocessing.get_context("fork").Pool(shards) as pool:
+            count = sum(pool.map(export_shard, jobs))
+
+        with open(outfile, "w", newline="", encoding="utf-8") as out:
+            if fmt == "csv":
+                csv.DictWriter(out, fieldnames=FIELDNAMES).writeheader()
+            for path, *rest in jobs:
+                with open(path, encoding="utf-8") as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(path)
+        return count
@@ -0,0 +1,365 @@
+import colorsys
+import csv
+import hashlib
+import multiprocessing
+import os.path
+import random
+import shutil
+from array import array
+from decimal import Decimal
+from io import BytesIO
+from itertools import accumulate
+
+from PIL import Image, ImageDraw
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max, Min
+
+from main import caching, models
+
+FIELDNAMES = ["name", "description", "tags", "image_filename", "price"]
+ADJECTIVES = (
+    "Silent", "Red", "Lost", "Hidden", "Last", "Golden", "Broken", "Northern",
+    "Secret", "Little", "Endless", "Dark", "Wild", "Forgotten", "Open", "Practical",
+)
+NOUNS = (
+    "River", "Garden", "Kingdom", "Code", "Bazaar", "Cathedral", "Journey", "Empire",
+    "Machine", "Island", "Winter", "Library", "Ocean", "Algorithm", "City", "Mountain",
+)
+GENRES = (
+    "Fiction", "Programming", "History", "Science", "Open source", "Poetry", "Travel",
+    "Business", "Children", "Fantasy", "Religion", "Narrative", "Art", "Cooking",
+)
+COVER_SIZE = (300, 450)
+COVER_DIR = "product-images"
+
+
+def cover_name(number):
+    return "cover-%d.jpg" % number
+
+
+def render_cover(number):
+    """Обложка: цветной фон по номеру и подпись"""
+    r, g, b = colorsys.hsv_to_rgb((number * 0.618) % 1, 0.5, 0.85)
+    image = Image.new("RGB", COVER_SIZE, (int(r * 255), int(g * 255), int(b * 255)))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 160, COVER_SIZE[0] - 20, 290), fill=(250, 250, 245))
+    draw.text((40, 210), "BookTime #%d" % number, fill=(30, 30, 30))
+    out = BytesIO()
+    image.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+def tag_names(count):
+    return ["%s %d" % (GENRES[rank % len(GENRES)], rank) for rank in range(1, count + 1)]
+
+
+def zipf_cum_weights(count, exponent):
+    """Накопленные веса закона Ципфа: ранг k выбирается с весом 1/k^s"""
+    return list(accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def product_rows(start, stop, seed, tags, cum_weights, covers):
+    """
+    Строки товаров с номерами [start, stop). Генератор случайных чисел
+    заводится на каждый номер товара от seed, поэтому результат не
+    зависит от числа процессов и размера пачек.
+    """
+    for number in range(start, stop):
+        rng = random.Random("%s-%d" % (seed, number))
+        name = "%s %s %d" % (rng.choice(ADJECTIVES), rng.choice(NOUNS), number)
+        product_tags = set(rng.choices(tags, cum_weights=cum_weights, k=rng.randint(1, 3)))
+        yield {
+            "number": number,
+            "name": name,
+            "description": "<p>%s about %s.</p>" % (name, " and ".join(sorted(t[1].lower() for t in product_tags))),
+            "price": Decimal(rng.randint(100, 9999)) / 100,
+            "stock": None if rng.random() < 0.3 else rng.randint(0, 200),
+            "tags": product_tags,
+            "cover": cover_name(rng.randrange(covers)) if covers else None,
+        }
+
+
+def create_products(args):
+    """Запись диапазона товаров в базу пачками, каждая пачка в своей транзакции"""
+    start, stop, options, tags, cum_weights = args
+    Through = models.Product.tags.through
+    count = 0
+    for chunk_start in range(start, stop, options["batch_size"]):
+        chunk_stop = min(chunk_start + options["batch_size"], stop)
+        rows = list(product_rows(chunk_start, chunk_stop, options["seed"], tags, cum_weights, options["covers"]))
+        with transaction.atomic():
+            products = models.Product.objects.bulk_create(
+                models.Product(
+                    name=row["name"][:32],
+                    slug=models.make_slug(row["name"]),
+                    description=row["description"],
+                    price=row["price"],
+                    stock=row["stock"],
+                )
+                for row in rows
+            )
+            Through.objects.bulk_create(
+                Through(product_id=product.id, producttag_id=tag_id)
+                for product, row in zip(products, rows)
+                for tag_id, tag_name in row["tags"]
+            )
+            images = models.ProductImage.objects.bulk_create(
+                models.ProductImage(product=product, image="%s/%s" % (COVER_DIR, row["cover"]))
+                for product, row in zip(products, rows)
+                if row["cover"]
+            )
+            # bulk_create не шлет post_save, задачи миниатюр ставятся здесь
+            models.RenditionJob.objects.bulk_create(
+                models.RenditionJob(product_image=image, source_hash=options["cover_hashes"][image.image.name])
+                for image in images
+            )
+        count += len(products)
+    connections.close_all()
+    return count
+
+
+def write_products(args):
+    """Запись диапазона товаров в csv для import_data"""
+    path, start, stop, options, tags, cum_weights = args
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        for row in product_rows(start, stop, options["seed"], tags, cum_weights, options["covers"]):
+            writer.writerow({
+                "name": row["name"],
+                "description": row["description"],
+                "tags": "|".join(tag_name for tag_id, tag_name in sorted(row["tags"])),
+                "image_filename": row["cover"] or "",
+                "price": str(row["price"]),
+            })
+            count += 1
+    return count
+
+
+class Command(BaseCommand):
+    """
+    Синтетический каталог для нагрузочного тестирования, команда:
+    python manage.py generate_catalog --products 1000000 --processes 8 --users 10000 --orders 100000
+
+    Выгрузка в csv и папку с обложками для import_data без записи товаров в базу:
+    python manage.py generate_catalog --products 100000 --csv catalog.csv
+
+    Тэги назначаются по закону Ципфа, обложки - небольшой набор
+    сгенерированных изображений, общий для всех товаров; для каждого фото
+    ставится задача миниатюр, их выполняет process_renditions. Номера
+    товаров и пользователей продолжают наибольший id, поэтому повторный
+    запуск не пересекается с прежними. Режим с несколькими процессами
+    рассчитан на PostgreSQL.
+    """
+    help = "Generate a synthetic catalog with users, baskets and orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--tags", type=int, default=50)
+        parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of tag popularity")
+        parser.add_argument("--covers", type=int, default=20, help="Distinct generated cover images")
+        parser.add_argument("--users", type=int, default=0)
+        parser.add_argument("--baskets", type=int, default=0)
+        parser.add_argument("--orders", type=int, default=0)
+        parser.add_argument("--max-lines", type=int, default=5, help="Max lines per basket and order")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--processes", type=int, default=1)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--csv", help="Write an import_data csv instead of inserting products")
+        parser.add_argument("--image-dir", help="Cover directory for --csv, defaults to <csv dir>/images")
+
+    def handle(self, *args, **options):
+        if options["processes"] < 1:
+            raise CommandError("--processes must be positive")
+        if (options["orders"] or options["baskets"]) and not options["users"] and not options["csv"]:
+            raise CommandError("--orders and --baskets need --users")
+        self.rng = random.Random(options["seed"])
+
+        if options["csv"]:
+            self.generate_csv(options)
+            return
+
+        # номер товара меньше его id, новые номера не совпадут с прежними
+        offset = models.Product.objects.aggregate(high=Max("id"))["high"] or 0
+        tags = self.create_tags(options)
+        options["cover_hashes"] = self.save_covers(options)
+        count = self.run_shards(create_products, offset, options, tags)
+        self.stdout.write("Products created=%d" % count)
+
+        if options["users"]:
+            users = self.create_users(options)
+            bounds = self.product_bounds(options)
+            prices = self.load_prices(bounds, options)
+            self.create_baskets(options, users, bounds, prices)
+            self.create_orders(options, users, bounds, prices)
+
+        caching.bump_versions(models.make_slug(name) for tag_id, name in tags)
+        self.stdout.write("Run rebuild_search_index to index the generated products")
+        if options["covers"]:
+            self.stdout.write("Run process_renditions to generate thumbnails for the generated covers")
+
+    def run_shards(self, func, offset, options, tags, path=None):
+        cum_weights = zipf_cum_weights(len(tags), options["zipf"])
+        # в дочерние процессы передаются только простые значения
+        options = {key: options.get(key) for key in ("products", "processes", "batch_size", "seed", "covers", "cover_hashes")}
+        processes = options["processes"]
+        step = options["products"] // processes + 1
+        ranges = [
+            (offset + i * step, offset + min((i + 1) * step, options["products"]))
+            for i in range(processes)
+            if i * step < options["products"]
+        ]
+        if path:
+            jobs = [("%s.part%d" % (path, i), start, stop, options, tags, cum_weights)
+                    for i, (start, stop) in enumerate(ranges)]
+        else:
+            jobs = [(start, stop, options, tags, cum_weights) for start, stop in ranges]
+
+        if processes == 1:
+            return sum(map(func, jobs))
+        # дочерние процессы открывают собственные соединения с базой
+        connections.close_all()
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            return sum(pool.map(func, jobs))
+
+    def create_tags(self, options):
+        """Тэги по рангу популярности: первый выбирается чаще всех"""
+        names = tag_names(options["tags"])
+        slugs = [models.make_slug(name) for name in names]
+        existing = set(models.ProductTag.objects.filter(slug__in=slugs).values_list("slug", flat=True))
+        models.ProductTag.objects.bulk_create(
+            models.ProductTag(name=name, slug=slug)
+            for name, slug in zip(names, slugs)
+            if slug not in existing
+        )
+        ids = dict(models.ProductTag.objects.filter(slug__in=slugs).values_list("slug", "id"))
+        return [(ids[slug], name) for name, slug in zip(names, slugs)]
+
+    def save_covers(self, options):
+        """Запись обложек, возвращает хэши файлов по именам"""
+        hashes = {}
+        for number in range(options["covers"]):
+            name = "%s/%s" % (COVER_DIR, cover_name(number))
+            data = render_cover(number)
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(data))
+            hashes[name] = hashlib.sha256(data).hexdigest()
+        return hashes
+
+    def generate_csv(self, options):
+        path = options["csv"]
+        image_dir = options["image_dir"] or os.path.join(os.path.dirname(os.path.abspath(path)), "images")
+        os.makedirs(image_dir, exist_ok=True)
+        for number in range(options["covers"]):
+            with open(os.path.join(image_dir, cover_name(number)), "wb") as f:
+                f.write(render_cover(number))
+
+        tags = [(name, name) for name in tag_names(options["tags"])]
+        count = self.run_shards(write_products, 0, options, tags, path=path)
+        with open(path, "w", newline="", encoding="utf-8") as out:
+            csv.DictWriter(out, fieldnames=FIELDNAMES).writeheader()
+            for i in range(options["processes"]):
+                part = "%s.part%d" % (path, i)
+                if os.path.exists(part):
+                    with open(part, encoding="utf-8") as f:
+                        shutil.copyfileobj(f, out)
+                    os.remove(part)
+        self.stdout.write("Products written=%d to %s, covers in %s" % (count, path, image_dir))
+
+    def create_users(self, options):
+        offset = models.User.objects.aggregate(high=Max("id"))["high"] or 0
+        password = make_password("booktime")
+        users = [
+            models.User(email="user%d@example.com" % number, password=password)
+            for number in range(offset, offset + options["users"])
+        ]
+        with transaction.atomic():
+            users = models.User.objects.bulk_create(users, batch_size=options["batch_size"])
+            addresses = [
+                models.Address(
+                    user=user,
+                    name="User %d" % user.id,
+                    address1="%d Strudel road" % self.rng.randint(1, 999),
+                    zip_code="%05d" % self.rng.randint(0, 99999),
+                    city=self.rng.choice(("London", "Moscow", "Berlin")),
+                    country=self.rng.choice(models.Address.SUPPORTED_COUNTRIES)[0],
+                )
+                for user in users
+            ]
+            models.Address.objects.bulk_create(addresses, batch_size=options["batch_size"])
+        self.stdout.write("Users created=%d" % len(users))
+        return [(user.id, address) for user, address in zip(users, addresses)]
+
+    def product_bounds(self, options):
+        bounds = models.Product.objects.aggregate(low=Min("id"), high=Max("id"))
+        if bounds["low"] is None:
+            raise CommandError("No products to put in baskets and orders")
+        return bounds["low"], bounds["high"]
+
+    def load_prices(self, bounds, options):
+        """Цены товаров диапазона id в копейках одним запросом, -1 на месте удаленных"""
+        low, high = bounds
+        prices = array("q", [-1]) * (high - low + 1)
+        products = models.Product.objects.filter(id__range=bounds).values_list("id", "price")
+        for product_id, price in products.iterator(chunk_size=options["batch_size"]):
+            prices[product_id - low] = int(price * 100)
+        return prices
+
+    def pick_lines(self, bounds, prices, options):
+        """Товары для корзины или заказа: случайные id и их цены"""
+        ids = {self.rng.randint(*bounds) for i in range(self.rng.randint(1, options["max_lines"]))}
+        return [
+            (product_id, Decimal(prices[product_id - bounds[0]]) / 100)
+            for product_id in sorted(ids)
+            if prices[product_id - bounds[0]] >= 0
+        ]
+
+    def create_baskets(self, options, users, bounds, prices):
+        for batch_start in range(0, options["baskets"], options["batch_size"]):
+            size = min(options["batch_size"], options["baskets"] - batch_start)
+            baskets, lines = [], []
+            for i in range(size):
+                basket = models.Basket(user_id=self.rng.choice(users)[0])
+                for product_id, price in self.pick_lines(bounds, prices, options):
+                    lines.append(models.BasketLine(basket=basket, product_id=product_id, quantity=self.rng.randint(1, 3)))
+                    basket.items_count += lines[-1].quantity
+                    basket.lines_count += 1
+                baskets.append(basket)
+            with transaction.atomic():
+                models.Basket.objects.bulk_create(baskets)
+                models.BasketLine.objects.bulk_create(lines)
+        self.stdout.write("Baskets created=%d" % options["baskets"])
+
+    def create_orders(self, options, users, bounds, prices):
+        statuses = [status for status, name in models.OrderLine.STATUSES]
+        for batch_start in range(0, options["orders"], options["batch_size"]):
+            size = min(options["batch_size"], options["orders"] - batch_start)
+            orders, lines = [], []
+            for i in range(size):
+                user_id, address = self.rng.choice(users)
+                order = models.Order(user_id=user_id, status=self.rng.choice(models.Order.STATUSES)[0])
+                for field in ("name", "address1", "address2", "zip_code", "city", "country"):
+                    setattr(order, "billing_%s" % field, getattr(address, field))
+                    setattr(order, "shipping_%s" % field, getattr(address, field))
+                order_lines = []
+                for product_id, price in self.pick_lines(bounds, prices, options):
+                    quantity = self.rng.randint(1, 3)
+                    order_lines.append(models.OrderLine(
+                        order=order,
+                        product_id=product_id,
+                        quantity=quantity,
+                        status=self.rng.choice(statuses),
+                        unit_price=price,
+                        line_total=price * quantity,
+                    ))
+                order.summary_from_lines(order_lines)
+                orders.append(order)
+                lines.extend(order_lines)
+            with transaction.atomic():
+                models.Order.objects.bulk_create(orders)
+                models.OrderLine.objects.bulk_create(lines, batch_size=models.ORDER_LINES_BATCH_SIZE)
+        self.stdout.write("Orders created=%d" % options["orders"])
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from main import invoices, models
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError("Invalid date %r, expected YYYY-MM-DD" % value)
+
+
+class Command(BaseCommand):
+    """
+    Счета за период пулом процессов, команда:
+    python manage.py generate_invoices --from 2021-01-01 --to 2021-01-31 --processes 8
+
+    Уже построенные счета с неизменным содержимым пропускаются.
+    """
+    help = "Generate PDF invoices for orders in a date range"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", type=parse_date, required=True)
+        parser.add_argument("--to", dest="date_to", type=parse_date, required=True)
+        parser.add_argument("--processes", type=int, default=os.cpu_count())
+        parser.add_argument("--chunk-size", type=int, default=200)
+
+    def handle(self, *args, **options):
+        try:
+            import weasyprint  # noqa: F401
+        except (ImportError, OSError):
+            raise CommandError("weasyprint is required to generate invoices: pipenv install")
+
+        tz = timezone.get_current_timezone()
+        start = timezone.make_aware(datetime.combine(options["date_from"], time.min), tz)
+        end = timezone.make_aware(datetime.combine(options["date_to"], time.max), tz)
+        ids = list(
+            models.Order.objects.filter(date_added__range=(start, end))
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        size = options["chunk_size"]
+        chunks = [ids[i:i + size] for i in range(0, len(ids), size)]
+
+        if options["processes"] > 1:
+            # дочерние процессы наследуют настроенный Django, как в export_data,
+            # и открывают свои соединения с базой
+            connections.close_all()
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=options["processes"], mp_context=context) as executor:
+                results = list(executor.map(invoices.generate_invoices, chunks))
+        else:
+            results = [invoices.generate_invoices(chunk) for chunk in chunks]
+
+        generated = sum(created for created, skipped in results)
+        skipped = sum(skipped for created, skipped in results)
+        self.stdout.write("Invoices generated=%d skipped=%d" % (generated, skipped))
@@ -1,48 +1,319 @@
 import csv
+import hashlib
 import os.path
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
+from django.core.files import File
 from django.core.files.images import ImageFile
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
-from django.template.defaultfilters import slugify
+from django.db import transaction
+from django.utils import timezone
 
-from main import models
+from main import caching, models, search
 
 
 class Command(BaseCommand):
     """
     Загрузка товаров из csv файла, команда:
     python manage.py import_data main/fixtures/product-sample.csv main/fixtures/product-sampleimages
+
+    Потоковая загрузка пачками с продолжением после прерывания:
+    python manage.py import_data catalog.csv images/ --stream --chunk-size 2000 --workers 8 --resume
+
+    Инкрементальная загрузка только изменившихся строк:
+    python manage.py import_data catalog.csv images/ --incremental --deactivate-missing
     """
     help = "Import products in BookTime"
 
     def add_arguments(self, parser):
         parser.add_argument("csvfile", type=open)
         parser.add_argument("image_basedir", type=str)
+        parser.add_argument("--stream", action="store_true", help="Import in bulk chunks")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=4, help="Threads copying images")
+        parser.add_argument("--resume", action="store_true", help="Continue from the last committed chunk")
+        parser.add_argument("--incremental", action="store_true", help="Import only rows whose fingerprints changed")
+        parser.add_argument("--deactivate-missing", action="store_true", help="Deactivate products missing from the feed")
 
     def handle(self, *args, **options):
         self.stdout.write("Importing products")
         c = Counter()
-        reader = csv.DictReader(options.pop("csvfile"))
-        for row in reader:
-            product, created = models.Product.objects.get_or_create(name=row["name"], price=row["price"])
-            product.description = row["description"]
-            product.slug = slugify(row["name"])
-            for import_tag in row["tags"].split("|"):
-                tag, tag_created = models.ProductTag.objects.get_or_create(name=import_tag)
-                product.tags.add(tag)
-                c["tags"] += 1
-                if tag_created:
-                    c["tags_created"] += 1
-            with open(os.path.join(options["image_basedir"], row["image_filename"]), "rb") as f:
-                image = models.ProductImage(product=product, image=ImageFile(f, name=row["image_filename"]),)
-                image.save()
-                c["images"] += 1
-            product.save()
+        csvfile = options.pop("csvfile")
+        reader = csv.DictReader(csvfile)
+        if options["stream"] or options["incremental"]:
+            self.import_stream(reader, os.path.abspath(csvfile.name), c, options)
+        else:
+            self.import_rows(reader, c, options)
+
+        self.stdout.write("Products processed=%d (created=%d)" % (c["products"], c["products_created"]))
+        self.stdout.write("Tags processed=%d (created=%d)" % (c["tags"], c["tags_created"]))
+        self.stdout.write("Images processed=%d" % c["images"])
+        if c["images"]:
+            self.stdout.write("Run process_renditions to generate thumbnails for the imported images")
+        if c["skipped"]:
+            self.stdout.write("Rows skipped=%d" % c["skipped"])
+
+    def import_rows(self, reader, c, options):
+        for line, row in enumerate(reader, start=2):
+            slug = models.make_slug(row["name"])
+            if not slug:
+                self.stderr.write("Row %d skipped: no slug for name %r" % (line, row["name"]))
+                c["skipped"] += 1
+                continue
+            # строка целиком или ничего, повторный импорт не оставляет полупустых товаров
+            with transaction.atomic():
+                product, created = models.Product.objects.get_or_create(
+                    slug=slug, defaults={"name": row["name"], "price": row["price"]},
+                )
+                product.name = row["name"]
+                product.price = row["price"]
+                product.description = row["description"]
+                for import_tag in row["tags"].split("|"):
+                    tag_slug = models.make_slug(import_tag)
+                    if not tag_slug:
+                        continue
+                    tag, tag_created = models.ProductTag.objects.get_or_create(
+                        slug=tag_slug, defaults={"name": import_tag},
+                    )
+                    product.tags.add(tag)
+                    c["tags"] += 1
+                    if tag_created:
+                        c["tags_created"] += 1
+                with open(os.path.join(options["image_basedir"], row["image_filename"]), "rb") as f:
+                    image = models.ProductImage(product=product, image=ImageFile(f, name=row["image_filename"]),)
+                    image.save()
+                    c["images"] += 1
+                product.save()
             c["products"] += 1
             if created:
                 c["products_created"] += 1
 
-        self.stdout.write("Products processed=%d (created=%d)" % (c["products"], c["products_created"]))
-        self.stdout.write("Tags processed=%d (created=%d)" % (c["tags"], c["tags_created"]))
-        self.stdout.write("Images processed=%d" % c["images"])
\ No newline at end of file
+    def import_stream(self, reader, source, c, options):
+        if not options["resume"]:
+            models.ImportCheckpoint.objects.filter(source=source).delete()
+        checkpoint, _ = models.ImportCheckpoint.objects.get_or_create(source=source)
+        start = checkpoint.rows_committed
+        if start:
+            self.stdout.write("Resuming after row %d" % start)
+        rows = islice(reader, start, None)
+        basedir = options["image_basedir"]
+        run_started = checkpoint.date_started if options["incremental"] else None
+
+        self.tag_ids = dict(models.ProductTag.objects.values_list("slug", "id"))
+        self.seen_slugs = set()
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while True:
+                chunk = list(islice(rows, options["chunk_size"]))
+                if not chunk:
+                    break
+                rows_read = len(chunk)
+                chunk = self.key_rows(chunk, start + 2, c)
+                unchanged_ids = []
+                if run_started:
+                    chunk, unchanged_ids = self.select_changed(chunk, executor, basedir, c)
+                images = list(executor.map(
+                    lambda row: store_image(basedir, row["image_filename"]) if row.get("_store_image", True) else None,
+                    chunk,
+                ))
+                with transaction.atomic():
+                    if chunk:
+                        self.import_chunk(chunk, images, c, run_started)
+                    if unchanged_ids:
+                        models.ProductFeedEntry.objects.filter(pk__in=unchanged_ids).update(last_seen=run_started)
+                    start += rows_read
+                    models.ImportCheckpoint.objects.filter(pk=checkpoint.pk).update(rows_committed=start)
+
+        if run_started:
+            self.finish_incremental(run_started, options["deactivate_missing"], c)
+        checkpoint.delete()
+
+    def key_rows(self, chunk, first_line, c):
+        """Слаг строки как у модели, строки без слага и повторы пропускаются"""
+        keyed = []
+        for line, row in enumerate(chunk, start=first_line):
+            slug = models.make_slug(row["name"])
+            if not slug:
+                self.stderr.write("Row %d skipped: no slug for name %r" % (line, row["name"]))
+            elif slug in self.seen_slugs:
+                self.stderr.write("Row %d skipped: duplicate slug %r" % (line, slug))
+            else:
+                self.seen_slugs.add(slug)
+                row["_slug"] = slug
+                keyed.append(row)
+                continue
+            c["skipped"] += 1
+        return keyed
+
+    def select_changed(self, chunk, executor, basedir, c):
+        """Отбор строк, у которых изменились данные или фото"""
+        image_hashes = executor.map(lambda row: hash_file(os.path.join(basedir, row["image_filename"])), chunk)
+        rows = {}
+        for row, image_hash in zip(chunk, image_hashes):
+            row["_row_hash"] = row_fingerprint(row)
+            row["_image_hash"] = image_hash
+            rows[row["_slug"]] = row
+
+        entries, inactive = {}, set()
+        for product in models.Product.objects.filter(slug__in=rows).select_related("feed_entry"):
+            entries.setdefault(product.slug, getattr(product, "feed_entry", None))
+            if not product.active:
+                inactive.add(product.slug)
+
+        changed, unchanged_ids = [], []
+        for slug, row in rows.items():
+            entry = entries.get(slug)
+            if slug not in entries:
+                c["added"] += 1
+            elif (entry and entry.row_hash == row["_row_hash"] and entry.image_hash == row["_image_hash"]
+                    and slug not in inactive):
+                c["unchanged"] += 1
+                unchanged_ids.append(entry.pk)
+                continue
+            else:
+                c["updated"] += 1
+            row["_store_image"] = entry is None or entry.image_hash != row["_image_hash"]
+            changed.append(row)
+        return changed, unchanged_ids
+
+    def import_chunk(self, chunk, images, c, run_started=None):
+        rows = {row["_slug"]: row for row in chunk}
+        existing = {}
+        for product in models.Product.objects.filter(slug__in=rows):
+            existing.setdefault(product.slug, product)
+
+        to_create, to_update = [], []
+        now = timezone.now()
+        for slug, row in rows.items():
+            product = existing.get(slug) or models.Product(slug=slug)
+            product.name = row["name"]
+            product.price = row["price"]
+            product.description = row["description"]
+            product.date_updated = now
+            if run_started:
+                # товар вернулся в фид после --deactivate-missing
+                product.active = True
+            (to_update if product.pk else to_create).append(product)
+        fields = ["name", "price", "description", "date_updated"] + (["active"] if run_started else [])
+        models.Product.objects.bulk_create(to_create)
+        models.Product.objects.bulk_update(to_update, fields)
+        products = {p.slug: p for p in to_create + to_update}
+        c["products"] += len(products)
+        c["products_created"] += len(to_create)
+
+        new_tags = {}
+        for row in chunk:
+            for name in row["tags"].split("|"):
+                slug = models.make_slug(name)
+                if slug and slug not in self.tag_ids:
+                    new_tags.setdefault(slug, models.ProductTag(name=name, slug=slug))
+        for tag in models.ProductTag.objects.bulk_create(new_tags.values()):
+            self.tag_ids[tag.slug] = tag.id
+        c["tags_created"] += len(new_tags)
+
+        through = models.Product.tags.through
+        # bulk-операции не шлют сигналов: версии кэша каталога меняются здесь,
+        # для новых тэгов строк и прежних тэгов обновленных товаров
+        tag_slugs = set(through.objects.filter(product__in=to_update).values_list("producttag__slug", flat=True))
+        if run_started:
+            through.objects.filter(product__in=to_update).delete()
+        links = []
+        for row in chunk:
+            product_id = products[row["_slug"]].id
+            for slug in {models.make_slug(name) for name in row["tags"].split("|")} - {""}:
+                links.append(through(product_id=product_id, producttag_id=self.tag_ids[slug]))
+                tag_slugs.add(slug)
+        through.objects.bulk_create(links, ignore_conflicts=True)
+        c["tags"] += len(links)
+        transaction.on_commit(lambda: caching.bump_versions(tag_slugs))
+        product_ids = [p.id for p in products.values()]
+        transaction.on_commit(lambda: search.reindex_products(product_ids))
+
+        stored = [(row, image) for row, image in zip(chunk, images) if image]
+        if run_started:
+            replaced = models.ProductImage.objects.filter(
+                product__in=[products[row["_slug"]] for row, image in stored if existing.get(row["_slug"])]
+            )
+            # файлы прежних фото, миниатюр и копий удаляются после коммита
+            names = list(replaced.values_list("image", flat=True))
+            names += [name for name in replaced.values_list("thumbnail", flat=True) if name]
+            names += models.ProductImageRendition.objects.filter(
+                product_image__in=replaced
+            ).values_list("image", flat=True)
+            replaced.delete()
+            transaction.on_commit(lambda: delete_files(names))
+        product_images = models.ProductImage.objects.bulk_create(
+            models.ProductImage(product=products[row["_slug"]], image=name)
+            for row, (name, source_hash) in stored
+        )
+        models.RenditionJob.objects.bulk_create(
+            models.RenditionJob(product_image=image, source_hash=source_hash)
+            for image, (row, (name, source_hash)) in zip(product_images, stored)
+        )
+        c["images"] += len(product_images)
+
+        if run_started:
+            models.ProductFeedEntry.objects.bulk_create(
+                [
+                    models.ProductFeedEntry(
+                        product=products[slug],
+                        row_hash=row["_row_hash"],
+                        image_hash=row["_image_hash"],
+                        last_seen=run_started,
+                    )
+                    for slug, row in rows.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["product"],
+                update_fields=["row_hash", "image_hash", "last_seen"],
+            )
+
+    def finish_incremental(self, run_started, deactivate_missing, c):
+        # записи пропавших из фида товаров удаляются, чтобы следующий запуск
+        # не считал их снова; вернувшийся товар загрузится как измененный
+        removed = models.ProductFeedEntry.objects.filter(last_seen__lt=run_started)
+        with transaction.atomic():
+            product_ids = list(removed.values_list("product_id", flat=True))
+            c["removed"] = len(product_ids)
+            removed.filter(product_id__in=product_ids).delete()
+            if deactivate_missing:
+                products = models.Product.objects.filter(id__in=product_ids, active=True)
+                tag_slugs = set(products.values_list("tags__slug", flat=True)) - {None}
+                product_ids = list(products.values_list("id", flat=True))
+                if products.update(active=False):
+                    transaction.on_commit(lambda: caching.bump_versions(tag_slugs))
+                    transaction.on_commit(lambda: search.reindex_products(product_ids))
+        self.stdout.write(
+            "Rows added=%d updated=%d unchanged=%d removed=%d"
+            % (c["added"], c["updated"], c["unchanged"], c["removed"])
+        )
+
+
+def row_fingerprint(row):
+    fields = (row["name"], row["description"], row["tags"], row["image_filename"], row["price"])
+    return hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def delete_files(names):
+    for name in set(names):
+        default_storage.delete(name)
+
+
+def store_image(basedir, filename):
+    """Копирование фото в хранилище и подсчет хэша, выполняется в пуле"""
+    upload_to = models.ProductImage._meta.get_field("image").upload_to
+    path = os.path.join(basedir, filename)
+    source_hash = hash_file(path)
+    with open(path, "rb") as f:
+        name = default_storage.save(os.path.join(upload_to, filename), File(f))
+    return name, source_hash
@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from main import renditions
+
+
+class Command(BaseCommand):
+    """
+    Обработка очереди миниатюр пулом процессов, команда:
+    python manage.py process_renditions --processes 4 --loop
+    """
+    help = "Generate product image renditions from the queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=os.cpu_count())
+        parser.add_argument("--batch-size", type=int, default=renditions.BATCH_SIZE)
+        parser.add_argument("--loop", action="store_true", help="Wait for new jobs instead of exiting")
+        parser.add_argument("--sleep", type=float, default=2.0)
+
+    def handle(self, *args, **options):
+        processed = 0
+        # дочерние процессы наследуют настроенный Django, как в export_data
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=options["processes"], mp_context=context) as executor:
+            while True:
+                # задачи, брошенные упавшим обработчиком, возвращаются на каждом круге
+                requeued = renditions.requeue_stale()
+                if requeued:
+                    self.stdout.write("Requeued stale jobs=%d" % requeued)
+                count = renditions.process_pending(executor, limit=options["batch_size"])
+                processed += count
+                if count:
+                    continue
+                if not options["loop"]:
+                    break
+                time.sleep(options["sleep"])
+
+        self.stdout.write("Renditions processed=%d" % processed)
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import search
+
+
+class Command(BaseCommand):
+    """
+    Перестройка поискового индекса товаров, команда:
+    python manage.py rebuild_search_index
+    """
+    help = "Rebuild the product search index"
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        index = search.build_index()
+        search.write_index(index)
+        self.stdout.write(
+            "Indexed products=%d terms=%d in %.1fs"
+            % (len(index.documents), len(index.postings), time.monotonic() - started)
+        )
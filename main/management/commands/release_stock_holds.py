@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import models
+
+
+class Command(BaseCommand):
+    """
+    Снятие просроченных резервов товара пачками, команда для cron:
+    python manage.py release_stock_holds --loop
+    """
+    help = "Release expired stock holds"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--loop", action="store_true", help="Keep sweeping instead of exiting")
+        parser.add_argument("--sleep", type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        released = 0
+        while True:
+            count = models.StockHold.objects.sweep_expired(limit=options["batch_size"])
+            released += count
+            if count:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
+
+        self.stdout.write("Stock holds released=%d" % released)
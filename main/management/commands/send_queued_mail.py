@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import outbox
+
+
+class Command(BaseCommand):
+    """
+    Отправка писем из очереди, команда:
+    python manage.py send_queued_mail --loop
+    """
+    help = "Send queued outgoing email"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=outbox.BATCH_SIZE)
+        parser.add_argument("--loop", action="store_true", help="Wait for new mail instead of exiting")
+        parser.add_argument("--sleep", type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            # письма, брошенные упавшим отправителем, возвращаются на каждом круге
+            requeued = outbox.requeue_stale()
+            if requeued:
+                self.stdout.write("Requeued stale emails=%d" % requeued)
+            count = outbox.send_pending(limit=options["batch_size"])
+            processed += count
+            if count:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
+
+        self.stdout.write("Emails processed=%d" % processed)
@@ -0,0 +1,142 @@
+"""
+Метрики запросов в памяти процесса.
+
+ProfilingMiddleware (включается настройкой PROFILING_ENABLED) собирает
+для каждого запроса время выполнения, число и время SQL-запросов,
+попадания в кэш и время рендера шаблонов, и складывает их в гистограммы
+по имени view. Значения отдаются в текстовом формате Prometheus;
+у каждого процесса свои гистограммы, их суммирует Prometheus.
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_current = contextvars.ContextVar("request_profile", default=None)
+
+
+class Histogram:
+    """Гистограмма Prometheus: счетчики по верхним границам корзин"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "%g" % bound, cumulative
+        yield "+Inf", self.count
+
+
+class Registry:
+    METRICS = {
+        "booktime_request_duration_seconds": ("histogram", "Request wall time", DURATION_BUCKETS),
+        "booktime_db_queries": ("histogram", "SQL queries per request", QUERY_BUCKETS),
+        "booktime_db_duration_seconds": ("histogram", "SQL time per request", DURATION_BUCKETS),
+        "booktime_template_render_seconds": ("histogram", "Template render time per request", DURATION_BUCKETS),
+        "booktime_cache_hits_total": ("counter", "Cache hits", None),
+        "booktime_cache_misses_total": ("counter", "Cache misses", None),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._values = defaultdict(dict)
+
+    def observe(self, name, view, value):
+        kind, help_text, buckets = self.METRICS[name]
+        with self._lock:
+            series = self._values[name]
+            if kind == "counter":
+                series[view] = series.get(view, 0) + value
+            else:
+                if view not in series:
+                    series[view] = Histogram(buckets)
+                series[view].observe(value)
+
+    def render(self):
+        """Текстовый формат Prometheus 0.0.4"""
+        out = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self.METRICS.items():
+                out.append("# HELP %s %s" % (name, help_text))
+                out.append("# TYPE %s %s" % (name, kind))
+                for view, value in sorted(self._values[name].items()):
+                    label = 'view="%s"' % view.replace("\\", "\\\\").replace('"', '\\"')
+                    if kind == "counter":
+                        out.append("%s{%s} %s" % (name, label, value))
+                        continue
+                    for bound, count in value.samples():
+                        out.append('%s_bucket{%s,le="%s"} %d' % (name, label, bound, count))
+                    out.append("%s_sum{%s} %s" % (name, label, value.sum))
+                    out.append("%s_count{%s} %d" % (name, label, value.count))
+        return "\n".join(out) + "\n"
+
+
+registry = Registry()
+
+
+class RequestProfile:
+    """Замеры одного запроса"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+        self.duration = None
+
+    @property
+    def db_time(self):
+        return sum(duration for sql, duration in self.queries)
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper для соединений с базой
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    def finish(self, view):
+        self.duration = time.perf_counter() - self.start
+        registry.observe("booktime_request_duration_seconds", view, self.duration)
+        registry.observe("booktime_db_queries", view, len(self.queries))
+        registry.observe("booktime_db_duration_seconds", view, self.db_time)
+        registry.observe("booktime_template_render_seconds", view, self.template_time)
+        registry.observe("booktime_cache_hits_total", view, self.cache_hits)
+        registry.observe("booktime_cache_misses_total", view, self.cache_misses)
+
+
+def start_profile():
+    profile = RequestProfile()
+    return profile, _current.set(profile)
+
+
+def end_profile(token):
+    _current.reset(token)
+
+
+def record_cache(hit):
+    """Учет обращения к кэшу, вне профилируемого запроса ничего не делает"""
+    profile = _current.get()
+    if profile is not None:
+        if hit:
+            profile.cache_hits += 1
+        else:
+            profile.cache_misses += 1
@@ -1,16 +1,152 @@
-from . import models
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+from functools import partial
 
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.functional import SimpleLazyObject
 
-def basket_middleware(get_response):
-    def middleware(request):
-        if 'basket_id' in request.session:
-            basket_id = request.session['basket_id']
+from . import metrics, models
+
+logger = logging.getLogger(__name__)
+
+BASKET_CACHE_TIMEOUT = getattr(settings, "BASKET_CACHE_TIMEOUT", 60 * 30)
+
+
+def get_basket(request):
+    """Корзина из сессии: сначала из кэша, затем из базы"""
+    basket_id = request.session.get("basket_id")
+    if basket_id is None:
+        return None
+
+    key = models.Basket.cache_key(basket_id)
+    basket = cache.get(key)
+    metrics.record_cache(basket is not None)
+    if basket is None:
+        try:
             basket = models.Basket.objects.get(id=basket_id)
-            request.basket = basket
-        else:
-            request.basket = None
+        except models.Basket.DoesNotExist:
+            logger.warning("Корзина id %s из сессии не найдена", basket_id)
+            del request.session["basket_id"]
+            return None
+        cache.set(key, basket, BASKET_CACHE_TIMEOUT)
+    return basket
 
-        response = get_response(request)
-        return response
+
+async def aget_basket(request):
+    """Асинхронный вариант get_basket для async-view"""
+    if hasattr(request, "_abasket"):
+        return request._abasket
+    basket_id = await request.session.aget("basket_id")
+    basket = None
+    if basket_id is not None:
+        key = models.Basket.cache_key(basket_id)
+        basket = await cache.aget(key)
+        metrics.record_cache(basket is not None)
+        if basket is None:
+            try:
+                basket = await models.Basket.objects.aget(id=basket_id)
+            except models.Basket.DoesNotExist:
+                logger.warning("Корзина id %s из сессии не найдена", basket_id)
+                await request.session.apop("basket_id")
+            else:
+                await cache.aset(key, basket, BASKET_CACHE_TIMEOUT)
+    request._abasket = basket
+    return basket
+
+
+def set_basket(request, has_basket):
+    if has_basket:
+        request.basket = SimpleLazyObject(lambda: get_basket(request))
+    else:
+        request.basket = None
+    request.abasket = partial(aget_basket, request)
+
+
+@sync_and_async_middleware
+def basket_middleware(get_response):
+    """
+    request.basket для sync-view и корутина request.abasket() для async-view.
+    Под ASGI цепочка middleware остается асинхронной.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            set_basket(request, await request.session.ahas_key("basket_id"))
+            return await get_response(request)
+    else:
+        def middleware(request):
+            set_basket(request, 'basket_id' in request.session)
+            return get_response(request)
 
     return middleware
+
+
+class ProfilingMiddleware:
+    """
+    Замеры времени, SQL, кэша и шаблонов по view для /metrics/.
+    Включается PROFILING_ENABLED, запросы дольше PROFILING_LATENCY_BUDGET
+    секунд пишутся в лог с самыми долгими и повторяющимися SQL.
+    """
+    TRACE_QUERIES = 5
+
+    def __init__(self, get_response):
+        if not getattr(settings, "PROFILING_ENABLED", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.latency_budget = getattr(settings, "PROFILING_LATENCY_BUDGET", 0.5)
+
+    def __call__(self, request):
+        profile, token = metrics.start_profile()
+        request.profile = profile
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            metrics.end_profile(token)
+
+        match = request.resolver_match
+        view = match.view_name if match else "unresolved"
+        profile.finish(view)
+        if profile.duration > self.latency_budget:
+            self.log_trace(request, view, profile)
+        return response
+
+    def process_template_response(self, request, response):
+        start = time.perf_counter()
+
+        def rendered(response):
+            request.profile.template_time += time.perf_counter() - start
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def log_trace(self, request, view, profile):
+        lines = [
+            "Медленный запрос %s %s (%s): %.0f мс, SQL %d за %.0f мс, кэш %d/%d, шаблоны %.0f мс" % (
+                request.method,
+                request.path,
+                view,
+                profile.duration * 1000,
+                len(profile.queries),
+                profile.db_time * 1000,
+                profile.cache_hits,
+                profile.cache_misses,
+                profile.template_time * 1000,
+            )
+        ]
+        for sql, duration in sorted(profile.queries, key=lambda q: -q[1])[:self.TRACE_QUERIES]:
+            lines.append("  %.1f мс %s" % (duration * 1000, sql))
+        # одинаковый текст запроса много раз - признак N+1
+        repeated = Counter(sql for sql, duration in profile.queries).most_common(self.TRACE_QUERIES)
+        for sql, count in repeated:
+            if count > 1:
+                lines.append("  x%d %s" % (count, sql))
+        logger.warning("\n".join(lines))
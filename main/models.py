@@ -1,16 +1,56 @@
+import hashlib
+import json
 import logging
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
 
 from ckeditor_uploader.fields import RichTextUploadingField
+from django.conf import settings
+from django.core.cache import cache
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from django.utils.text import slugify
 from django.contrib.auth.models import (AbstractUser,
                                         BaseUserManager,
                                         )
 
-from . import exceptions
+from . import caching, exceptions, metrics
 
 logger = logging.getLogger(__name__)
 
+ORDER_LINES_BATCH_SIZE = 500
+IMAGE_MANIFEST_TIMEOUT = 60 * 60 * 24
+STOCK_HOLD_TIMEOUT = getattr(settings, "STOCK_HOLD_TIMEOUT", 60 * 15)
+
+
+# <slug:slug> в адресах принимает только латиницу, кириллица транслитерируется
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "iu",
+    "я": "ia", "і": "i", "ї": "i", "є": "ie", "ґ": "g",
+})
+
+
+def make_slug(name):
+    """ASCII-слаг из названия, пустой если в названии нет букв латиницы или кириллицы"""
+    return slugify(name.lower().translate(TRANSLIT))[:48].strip("-")
+
+
+def unique_slug(model, name, pk=None):
+    """Свободный слаг для модели, при совпадении добавляется номер"""
+    base = make_slug(name) or model._meta.model_name
+    slug, n = base, 1
+    while model._default_manager.filter(slug=slug).exclude(pk=pk).exists():
+        n += 1
+        suffix = "-%d" % n
+        slug = base[:48 - len(suffix)].strip("-") + suffix
+    return slug
+
 
 class ProductTagManager(models.Manager):
     def get_by_natural_key(self, slug):
@@ -20,7 +60,7 @@ class ProductTagManager(models.Manager):
 class ProductTag(models.Model):
     """Тэг"""
     name = models.CharField('Название', max_length=32)
-    slug = models.SlugField('URL', max_length=48)
+    slug = models.SlugField('URL', max_length=48, unique=True)
     description = models.TextField('Описание', blank=True)
     active = models.BooleanField('Добавить', default=True)
 
@@ -33,6 +73,11 @@ class ProductTag(models.Model):
         verbose_name = "Тэг"
         verbose_name_plural = "Тэги"
 
+    def save(self, *args, **kwargs):
+        if not self.slug:
+            self.slug = unique_slug(type(self), self.name, self.pk)
+        super().save(*args, **kwargs)
+
     def natural_key(self):
         return self.slug
 
@@ -48,9 +93,10 @@ class Product(models.Model):
     name = models.CharField('Название', max_length=32)
     description = RichTextUploadingField('Описание', blank=True)
     price = models.DecimalField('Стоимость', max_digits=6, decimal_places=2)
-    slug = models.SlugField('URL', max_length=48)
+    slug = models.SlugField('URL', max_length=48, unique=True)
     active = models.BooleanField('Добавить', default=True)
-    in_stock = models.BooleanField('В наличии', default=True)
+    stock = models.PositiveIntegerField('Остаток', null=True, blank=True, help_text='Пусто - остаток не учитывается')
+    reserved = models.PositiveIntegerField('В резерве', default=0)
     date_updated = models.DateTimeField('Дата обновления', auto_now=True)
 
     objects = ActiveManager()
@@ -61,6 +107,68 @@ class Product(models.Model):
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
+        indexes = [
+            # список товаров: active=True ORDER BY name, id
+            models.Index(fields=["name", "id"], condition=Q(active=True), name="product_active_name_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self.slug:
+            self.slug = unique_slug(type(self), self.name, self.pk)
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # reserved меняется только условными UPDATE резервирования,
+            # сохранение формы не должно затирать его устаревшим значением
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != "reserved"
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def available(self):
+        """Свободный остаток, None если остаток не учитывается"""
+        if self.stock is None:
+            return None
+        return max(self.stock - self.reserved, 0)
+
+    @property
+    def in_stock(self):
+        return self.stock is None or self.stock > self.reserved
+
+    def _image_manifest_key(self):
+        return "product-images:%d:%s" % (self.pk, self.date_updated.timestamp())
+
+    def _image_manifest_queryset(self):
+        return self.productimage_set.prefetch_related("renditions").order_by("id")
+
+    @staticmethod
+    def _image_manifest_entry(image):
+        return {
+            "id": image.id,
+            "image": image.image.url,
+            "thumbnail": image.thumbnail.url if image.thumbnail else image.image.url,
+            "srcset": image.srcset(),
+            "srcset_webp": image.srcset_webp,
+        }
+
+    def image_manifest(self):
+        """Фото товара для галереи, кэшируется до изменения товара"""
+        key = self._image_manifest_key()
+        manifest = cache.get(key)
+        metrics.record_cache(manifest is not None)
+        if manifest is None:
+            manifest = [self._image_manifest_entry(image) for image in self._image_manifest_queryset()]
+            cache.set(key, manifest, IMAGE_MANIFEST_TIMEOUT)
+        return manifest
+
+    async def aimage_manifest(self):
+        key = self._image_manifest_key()
+        manifest = await cache.aget(key)
+        metrics.record_cache(manifest is not None)
+        if manifest is None:
+            manifest = [self._image_manifest_entry(image) async for image in self._image_manifest_queryset()]
+            await cache.aset(key, manifest, IMAGE_MANIFEST_TIMEOUT)
+        return manifest
 
 
 class ProductImage(models.Model):
@@ -68,11 +176,92 @@ class ProductImage(models.Model):
     product = models.ForeignKey(Product, verbose_name='Продукт', on_delete=models.CASCADE)
     image = models.ImageField('Фото товара', upload_to="product-images")
     thumbnail = models.ImageField('Миниатюра', upload_to="product-thumbnails", null=True)
+    image_hash = models.CharField('Хэш исходного фото', max_length=64, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Фото товара"
         verbose_name_plural = "Фото товаров"
 
+    def srcset(self, format="jpeg"):
+        """Значение srcset из уменьшенных копий в заданном формате"""
+        renditions = sorted(
+            (r for r in self.renditions.all() if r.format == format),
+            key=lambda r: r.width,
+        )
+        return ", ".join("%s %dw" % (r.image.url, r.width) for r in renditions)
+
+    @property
+    def srcset_webp(self):
+        return self.srcset("webp")
+
+
+class ProductImageRendition(models.Model):
+    """Уменьшенная копия фото товара"""
+    product_image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name="renditions")
+    name = models.CharField('Размер', max_length=16)
+    format = models.CharField('Формат', max_length=8)
+    width = models.PositiveIntegerField('Ширина')
+    height = models.PositiveIntegerField('Высота')
+    image = models.ImageField('Файл', upload_to="product-renditions")
+
+    class Meta:
+        verbose_name = "Копия фото товара"
+        verbose_name_plural = "Копии фото товаров"
+        constraints = [
+            models.UniqueConstraint(fields=["product_image", "name", "format"], name="unique_rendition"),
+        ]
+
+
+class RenditionJob(models.Model):
+    """Задача на генерацию миниатюр"""
+    NEW = 10
+    PROCESSING = 20
+    DONE = 30
+    FAILED = 40
+    STATUSES = ((NEW, "New"), (PROCESSING, "Processing"), (DONE, "Done"), (FAILED, "Failed"))
+
+    product_image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name="rendition_jobs")
+    source_hash = models.CharField(max_length=64)
+    status = models.IntegerField(choices=STATUSES, default=NEW)
+    attempts = models.PositiveIntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Задача миниатюр"
+        verbose_name_plural = "Задачи миниатюр"
+        indexes = [
+            # очередь новых задач: status=NEW ORDER BY id
+            models.Index(fields=["id"], condition=Q(status=10), name="renditionjob_new_idx"),
+        ]
+
+
+class ImportCheckpoint(models.Model):
+    """Позиция потокового импорта для продолжения прерванной загрузки"""
+    source = models.CharField('Файл', max_length=255, unique=True)
+    rows_committed = models.PositiveIntegerField('Загружено строк', default=0)
+    date_started = models.DateTimeField('Начало загрузки', auto_now_add=True)
+    date_updated = models.DateTimeField('Дата обновления', auto_now=True)
+
+    class Meta:
+        verbose_name = "Позиция импорта"
+        verbose_name_plural = "Позиции импорта"
+
+
+class ProductFeedEntry(models.Model):
+    """Отпечатки строки фида и фото для инкрементального импорта"""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name="feed_entry")
+    row_hash = models.CharField('Хэш строки', max_length=64)
+    image_hash = models.CharField('Хэш фото', max_length=64, blank=True)
+    last_seen = models.DateTimeField('Последний импорт')
+
+    class Meta:
+        verbose_name = "Запись фида"
+        verbose_name_plural = "Записи фида"
+        indexes = [
+            models.Index(fields=["last_seen"], name="feedentry_last_seen_idx"),
+        ]
+
 
 class UserManager(BaseUserManager):
     use_in_migrations = True
@@ -137,18 +326,111 @@ class Basket(models.Model):
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)
     status = models.IntegerField(choices=STATUSES, default=OPEN)
+    items_count = models.PositiveIntegerField("Товаров", default=0)
+    lines_count = models.PositiveIntegerField("Позиций", default=0)
 
     class Meta:
         verbose_name = "Заказ"
         verbose_name_plural = "Заказы"
+        indexes = [
+            models.Index(fields=["user", "status"], name="basket_user_status_idx"),
+        ]
+
+    @staticmethod
+    def cache_key(basket_id):
+        return "basket:%s" % basket_id
+
+    def invalidate_cache(self):
+        cache.delete(self.cache_key(self.id))
 
     def is_empty(self):
-        return self.basketline_set.all().count() == 0
+        return self.lines_count == 0
 
     def count(self):
-        return sum(i.quantity for i in self.basketline_set.all())
+        return self.items_count
 
-    def create_order(self, billing_address, shipping_address):
+    def increment_counts(self, items=0, lines=0):
+        """Атомарное изменение счетчиков без пересчета строк"""
+        Basket.objects.filter(pk=self.pk).update(
+            items_count=F("items_count") + items,
+            lines_count=F("lines_count") + lines,
+        )
+        self.items_count += items
+        self.lines_count += lines
+        self.invalidate_cache()
+
+    def update_counts(self):
+        """Пересчет счетчиков по строкам корзины"""
+        totals = self.basketline_set.aggregate(items=Sum("quantity"), lines=Count("id"))
+        self.items_count = totals["items"] or 0
+        self.lines_count = totals["lines"]
+        Basket.objects.filter(pk=self.pk).update(
+            items_count=self.items_count,
+            lines_count=self.lines_count,
+        )
+        self.invalidate_cache()
+
+    def add_product(self, product, quantity=1):
+        """
+        Атомарное добавление товара: UPDATE с F(), при отсутствии строки - INSERT
+        в точке сохранения, при гонке на уникальности - повторный UPDATE.
+        Для товаров с учетом остатка сначала ставится резерв.
+        """
+        if product.stock is not None:
+            StockHold.objects.hold(self, product, quantity)
+        lines = BasketLine.objects.filter(basket=self, product=product)
+        created = False
+        if not lines.update(quantity=F("quantity") + quantity):
+            try:
+                with transaction.atomic():
+                    BasketLine.objects.create(basket=self, product=product, quantity=quantity)
+                created = True
+            except IntegrityError:
+                lines.update(quantity=F("quantity") + quantity)
+        self.increment_counts(items=quantity, lines=int(created))
+        return created
+
+    def merge(self, baskets):
+        """
+        Перенос строк и резервов из других корзин с суммированием количества по товару.
+        Число запросов не зависит от размера корзин, вызывать в транзакции.
+        """
+        basket_ids = [b.pk for b in baskets]
+        totals = (
+            BasketLine.objects.filter(basket_id__in=basket_ids + [self.pk])
+            .values("product_id")
+            .annotate(total=Sum("quantity"))
+        )
+        kept, duplicates = {}, []
+        for line in self.basketline_set.order_by("id"):
+            if line.product_id in kept:
+                duplicates.append(line.pk)
+            else:
+                kept[line.product_id] = line
+
+        to_update, to_create = [], []
+        for row in totals:
+            line = kept.get(row["product_id"])
+            if line is None:
+                to_create.append(BasketLine(basket=self, product_id=row["product_id"], quantity=row["total"]))
+            elif line.quantity != row["total"]:
+                line.quantity = row["total"]
+                to_update.append(line)
+
+        BasketLine.objects.filter(Q(basket_id__in=basket_ids) | Q(pk__in=duplicates)).delete()
+        BasketLine.objects.bulk_update(to_update, ["quantity"])
+        BasketLine.objects.bulk_create(to_create)
+        # резервы переходят вместе со строками, иначе удаление корзин их снимет
+        StockHold.objects.merge(self, baskets)
+        Basket.objects.filter(pk__in=basket_ids).delete()
+        self.update_counts()
+
+    def create_order(self, billing_address, shipping_address, per_unit=True):
+        """Оформление заказа.
+
+        При per_unit=True на каждую единицу товара создается отдельная
+        строка заказа, иначе одна строка на позицию корзины с количеством.
+        """
         if not self.user:
             raise exceptions.BasketException("Cannot create order without user")
 
@@ -175,27 +457,47 @@ class Basket(models.Model):
             "shipping_city": shipping_address.city,
             "shipping_country": shipping_address.country,
         }
-        order = Order.objects.create(**order_data)
-        c = 0
-        for line in self.basketline_set.all():
-            for item in range(line.quantity):
-                order_line_data = {
-                    "order": order,
-                    "product": line.product,
-                }
-                order_line = OrderLine.objects.create(
-                    **order_line_data
-                )
-                c += 1
-
-        logger.info(
-            "Created order with id=%d and lines_count=%d",
-            order.id,
-            c,
-        )
-
-        self.status = Basket.SUBMITTED
-        self.save()
+        with transaction.atomic():
+            basket_lines = list(self.basketline_set.select_related("product"))
+            order = Order(**order_data)
+            lines = []
+            for line in basket_lines:
+                if per_unit:
+                    lines.extend(
+                        OrderLine(
+                            order=order,
+                            product=line.product,
+                            unit_price=line.product.price,
+                            line_total=line.product.price,
+                        )
+                        for item in range(line.quantity)
+                    )
+                else:
+                    lines.append(
+                        OrderLine(
+                            order=order,
+                            product=line.product,
+                            quantity=line.quantity,
+                            unit_price=line.product.price,
+                            line_total=line.product.price * line.quantity,
+                        )
+                    )
+            # сводка считается по строкам в памяти и пишется вместе с заказом
+            order.summary_from_lines(lines)
+            order.save()
+            OrderLine.objects.bulk_create(lines, batch_size=ORDER_LINES_BATCH_SIZE)
+            # остаток списывается последним, блокировки строк товаров
+            # держатся только до конца транзакции
+            StockHold.objects.allocate(self, basket_lines)
+
+            logger.info(
+                "Created order with id=%d and lines_count=%d",
+                order.id,
+                len(lines),
+            )
+
+            self.status = Basket.SUBMITTED
+            self.save(update_fields=["status"])
         return order
 
 
@@ -204,6 +506,170 @@ class BasketLine(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField("Количество:", default=1, validators=[MinValueValidator(1)])
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["basket", "product"], name="basketline_basket_product_uniq"),
+        ]
+
+
+class StockHoldManager(models.Manager):
+    """
+    Резервы остатка под корзины. Все операции - условные UPDATE строки
+    товара без чтения остатка в Python; строки резервов блокируются раньше
+    строк товаров, товары - по возрастанию id, чтобы не было взаимных блокировок.
+    """
+    def hold(self, basket, product, quantity=1):
+        """Резерв товара под корзину, OutOfStock при нехватке остатка"""
+        expires_at = timezone.now() + timedelta(seconds=STOCK_HOLD_TIMEOUT)
+        with transaction.atomic():
+            holds = self.filter(basket=basket, product=product)
+            if not holds.update(quantity=F("quantity") + quantity, expires_at=expires_at):
+                try:
+                    with transaction.atomic():
+                        self.create(basket=basket, product=product, quantity=quantity, expires_at=expires_at)
+                except IntegrityError:
+                    holds.update(quantity=F("quantity") + quantity, expires_at=expires_at)
+            reserved = Product.objects.filter(
+                pk=product.pk, stock__gte=F("reserved") + quantity
+            ).update(reserved=F("reserved") + quantity)
+            if not reserved:
+                raise exceptions.OutOfStock(product)
+            transaction.on_commit(caching.bump_stock_version)
+
+    def set_quantity(self, basket, product, quantity):
+        """Резерв товара под корзину ровно на quantity, OutOfStock при нехватке остатка"""
+        expires_at = timezone.now() + timedelta(seconds=STOCK_HOLD_TIMEOUT)
+        with transaction.atomic():
+            hold = self.select_for_update().filter(basket=basket, product=product).first()
+            delta = quantity - (hold.quantity if hold else 0)
+            if delta > 0:
+                reserved = Product.objects.filter(
+                    pk=product.pk, stock__gte=F("reserved") + delta
+                ).update(reserved=F("reserved") + delta)
+                if not reserved:
+                    raise exceptions.OutOfStock(product)
+            elif delta < 0:
+                Product.objects.filter(pk=product.pk).update(reserved=F("reserved") + delta)
+            if delta:
+                transaction.on_commit(caching.bump_stock_version)
+            if hold is None:
+                if quantity:
+                    self.create(basket=basket, product=product, quantity=quantity, expires_at=expires_at)
+            elif quantity:
+                self.filter(pk=hold.pk).update(quantity=quantity, expires_at=expires_at)
+            else:
+                hold.delete()
+
+    def merge(self, basket, baskets):
+        """
+        Перенос резервов других корзин в basket с суммированием по товару.
+        Резерв товара не меняется, вызывать в транзакции до удаления корзин.
+        """
+        basket_ids = [b.pk for b in baskets]
+        holds = list(self.select_for_update().filter(basket_id__in=basket_ids + [basket.pk]).order_by("id"))
+        kept, totals = {}, defaultdict(int)
+        expires = {}
+        for hold in holds:
+            totals[hold.product_id] += hold.quantity
+            expires[hold.product_id] = max(expires.get(hold.product_id, hold.expires_at), hold.expires_at)
+            if hold.basket_id == basket.pk:
+                kept[hold.product_id] = hold
+
+        to_update, to_create = [], []
+        for product_id, quantity in totals.items():
+            hold = kept.get(product_id)
+            if hold is None:
+                to_create.append(
+                    StockHold(basket=basket, product_id=product_id, quantity=quantity, expires_at=expires[product_id])
+                )
+            elif hold.quantity != quantity:
+                hold.quantity, hold.expires_at = quantity, expires[product_id]
+                to_update.append(hold)
+        self.filter(basket_id__in=basket_ids).delete()
+        self.bulk_update(to_update, ["quantity", "expires_at"])
+        self.bulk_create(to_create)
+
+    def allocate(self, basket, lines):
+        """
+        Списание остатка по строкам корзины с учетом ее резервов.
+        Нехватка сверх резерва - OutOfStock, вызывать в транзакции.
+        """
+        holds = dict(
+            self.select_for_update().filter(basket=basket).values_list("product_id", "quantity")
+        )
+        needed = defaultdict(int)
+        products = {}
+        for line in lines:
+            if line.product.stock is not None:
+                needed[line.product_id] += line.quantity
+                products[line.product_id] = line.product
+
+        for product_id in sorted(set(needed) | set(holds)):
+            need, held = needed.get(product_id, 0), holds.get(product_id, 0)
+            if not need:
+                Product.objects.filter(pk=product_id).update(reserved=F("reserved") - held)
+                continue
+            allocated = Product.objects.filter(
+                pk=product_id, stock__gte=F("reserved") - held + need
+            ).update(stock=F("stock") - need, reserved=F("reserved") - held)
+            if not allocated:
+                raise exceptions.OutOfStock(products[product_id])
+        if holds:
+            self.filter(basket=basket).delete()
+        if needed or holds:
+            transaction.on_commit(caching.bump_stock_version)
+
+    def release(self, basket):
+        """Снятие всех резервов корзины"""
+        with transaction.atomic():
+            holds = list(
+                self.select_for_update().filter(basket=basket).values_list("id", "product_id", "quantity")
+            )
+            self._release(holds)
+        return len(holds)
+
+    def sweep_expired(self, limit=1000):
+        """
+        Снятие пачки просроченных резервов. Строки, заблокированные
+        оформлением заказа или другим процессом, пропускаются.
+        """
+        with transaction.atomic():
+            holds = list(
+                self.select_for_update(skip_locked=True)
+                .filter(expires_at__lte=timezone.now())
+                .order_by("id")
+                .values_list("id", "product_id", "quantity")[:limit]
+            )
+            self._release(holds)
+        return len(holds)
+
+    def _release(self, holds):
+        totals = defaultdict(int)
+        for hold_id, product_id, quantity in holds:
+            totals[product_id] += quantity
+        for product_id in sorted(totals):
+            Product.objects.filter(pk=product_id).update(reserved=F("reserved") - totals[product_id])
+        if holds:
+            self.filter(id__in=[hold[0] for hold in holds]).delete()
+            transaction.on_commit(caching.bump_stock_version)
+
+
+class StockHold(models.Model):
+    """Резерв товара под корзину"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="holds")
+    basket = models.ForeignKey(Basket, on_delete=models.CASCADE, related_name="holds")
+    quantity = models.PositiveIntegerField(default=1)
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = StockHoldManager()
+
+    class Meta:
+        verbose_name = "Резерв"
+        verbose_name_plural = "Резервы"
+        constraints = [
+            models.UniqueConstraint(fields=["basket", "product"], name="stockhold_basket_product_uniq"),
+        ]
+
 
 class Order(models.Model):
     """Заказ"""
@@ -228,6 +694,81 @@ class Order(models.Model):
     shipping_country = models.CharField(max_length=3)
     date_updated = models.DateTimeField(auto_now=True)
     date_added = models.DateTimeField(auto_now_add=True)
+    lines_count = models.PositiveIntegerField("Строк", default=0)
+    items_count = models.PositiveIntegerField("Товаров", default=0)
+    products_count = models.PositiveIntegerField("Наименований", default=0)
+    new_count = models.PositiveIntegerField("Новые", default=0)
+    processing_count = models.PositiveIntegerField("В обработке", default=0)
+    sent_count = models.PositiveIntegerField("Отправлены", default=0)
+    cancelled_count = models.PositiveIntegerField("Отменены", default=0)
+    total = models.DecimalField("Сумма", max_digits=12, decimal_places=2, null=True, blank=True)
+    invoice = models.FileField("Счет", upload_to="invoices", blank=True)
+
+    class Meta:
+        indexes = [
+            # отчеты по выручке: SUM(total) по диапазону дат без обращения к таблице
+            models.Index(fields=["date_added", "total"], name="order_date_total_idx"),
+        ]
+
+    def summary_from_lines(self, lines):
+        """Сводка по строкам заказа в памяти, без запросов"""
+        self.lines_count = len(lines)
+        self.items_count = sum(line.quantity for line in lines)
+        self.products_count = len({line.product_id for line in lines})
+        self.total = sum((line.line_total for line in lines), Decimal("0.00"))
+        for field in OrderLine.STATUS_COUNTERS.values():
+            setattr(self, field, 0)
+        for line in lines:
+            field = OrderLine.STATUS_COUNTERS[line.status]
+            setattr(self, field, getattr(self, field) + line.quantity)
+
+    def update_summary(self):
+        """Пересчет сводки по строкам заказа одним запросом"""
+        totals = self.lines.aggregate(
+            lines=Count("id"),
+            items=Sum("quantity"),
+            products=Count("product", distinct=True),
+            total=Sum("line_total"),
+            **{
+                field: Sum("quantity", filter=Q(status=status))
+                for status, field in OrderLine.STATUS_COUNTERS.items()
+            }
+        )
+        values = {
+            "lines_count": totals.pop("lines"),
+            "items_count": totals.pop("items") or 0,
+            "products_count": totals.pop("products"),
+            "total": totals.pop("total"),
+        }
+        values.update((field, value or 0) for field, value in totals.items())
+        for field, value in values.items():
+            setattr(self, field, value)
+        Order.objects.filter(pk=self.pk).update(**values)
+
+
+class OrderLineQuerySet(models.QuerySet):
+    def set_status(self, status):
+        """
+        Массовая смена статуса строк со сдвигом счетчиков заказов:
+        одна агрегация по (заказ, старый статус) и UPDATE на каждый заказ.
+        """
+        counter = OrderLine.STATUS_COUNTERS[status]
+        with transaction.atomic():
+            lines = self.select_for_update().exclude(status=status)
+            moved = defaultdict(lambda: defaultdict(int))
+            ids = []
+            for line_id, order_id, old_status, quantity in lines.values_list("id", "order_id", "status", "quantity"):
+                moved[order_id][old_status] += quantity
+                ids.append(line_id)
+            OrderLine.objects.filter(id__in=ids).update(status=status)
+            for order_id, by_status in moved.items():
+                changes = {
+                    OrderLine.STATUS_COUNTERS[old]: F(OrderLine.STATUS_COUNTERS[old]) - quantity
+                    for old, quantity in by_status.items()
+                }
+                changes[counter] = F(counter) + sum(by_status.values())
+                Order.objects.filter(pk=order_id).update(**changes)
+        return len(ids)
 
 
 class OrderLine(models.Model):
@@ -236,9 +777,93 @@ class OrderLine(models.Model):
     SENT = 30
     CANCELLED = 40
     STATUSES = ((NEW, "New"), (PROCESSING, "Processing"), (SENT, "Sent"), (CANCELLED, "Cancelled"))
+    # статус строки -> счетчик товаров в сводке заказа
+    STATUS_COUNTERS = {
+        NEW: "new_count",
+        PROCESSING: "processing_count",
+        SENT: "sent_count",
+        CANCELLED: "cancelled_count",
+    }
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="lines")
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
+    quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
     status = models.IntegerField(choices=STATUSES, default=NEW)
+    unit_price = models.DecimalField("Цена", max_digits=6, decimal_places=2, null=True, blank=True)
+    line_total = models.DecimalField("Сумма", max_digits=10, decimal_places=2, null=True, blank=True)
+
+    objects = OrderLineQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["order", "status"], name="orderline_order_status_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.unit_price is not None:
+            self.line_total = self.unit_price * self.quantity
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # исходные значения для сдвига счетчиков заказа при сохранении
+        instance._loaded = tuple(instance.__dict__.get(f) for f in ("status", "quantity", "product_id", "unit_price"))
+        return instance
+
+
+class OutgoingEmailManager(models.Manager):
+    def enqueue(self, subject, body, from_email, to, dedupe_key=None):
+        """
+        Письмо в очередь вместо отправки в запросе. Повтор с тем же
+        ключом (по умолчанию хэш содержимого), пока письмо еще не
+        отправлено, не создает второе письмо.
+        """
+        if dedupe_key is None:
+            content = json.dumps([subject, body, from_email, sorted(to)], ensure_ascii=False)
+            dedupe_key = hashlib.sha256(content.encode()).hexdigest()
+        email, created = self.get_or_create(
+            dedupe_key=dedupe_key,
+            status__in=OutgoingEmail.PENDING,
+            defaults={"subject": subject, "body": body, "from_email": from_email, "to": list(to)},
+        )
+        return email, created
 
 
+class OutgoingEmail(models.Model):
+    """Письмо в очереди на отправку"""
+    NEW = 10
+    SENDING = 20
+    SENT = 30
+    FAILED = 40
+    STATUSES = ((NEW, "New"), (SENDING, "Sending"), (SENT, "Sent"), (FAILED, "Failed"))
+    PENDING = (NEW, SENDING)
+
+    subject = models.CharField("Тема", max_length=255)
+    body = models.TextField("Текст")
+    from_email = models.CharField("От", max_length=255)
+    to = models.JSONField("Кому", default=list)
+    dedupe_key = models.CharField(max_length=255, db_index=True)
+    status = models.IntegerField(choices=STATUSES, default=NEW)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    send_after = models.DateTimeField(default=timezone.now)
+    date_sent = models.DateTimeField(null=True, blank=True)
+    date_updated = models.DateTimeField(auto_now=True)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    objects = OutgoingEmailManager()
+
+    class Meta:
+        verbose_name = "Письмо"
+        verbose_name_plural = "Исходящие письма"
+        indexes = [
+            # очередь: status=NEW AND send_after <= now ORDER BY send_after
+            models.Index(fields=["send_after"], condition=Q(status=10), name="outgoingemail_new_idx"),
+        ]
+        constraints = [
+            # ключ повтора занят, пока письмо ждет отправки; после отправки
+            # то же письмо (повторное обращение, регистрация) можно поставить снова
+            models.UniqueConstraint(
+                fields=["dedupe_key"], condition=Q(status__in=(10, 20)), name="outgoingemail_pending_dedupe_uniq",
+            ),
+        ]
@@ -0,0 +1,92 @@
+"""
+Отправка писем из очереди OutgoingEmail.
+
+Формы только записывают письмо в таблицу, запрос не ждет SMTP.
+Команда send_queued_mail забирает пачку писем (SKIP LOCKED, несколько
+обработчиков не мешают друг другу) и отправляет ее через одно
+соединение get_connection(). Неудачные письма откладываются с
+экспоненциальной задержкой, после MAX_ATTEMPTS помечаются FAILED.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = getattr(settings, "OUTBOX_MAX_ATTEMPTS", 5)
+RETRY_DELAY = getattr(settings, "OUTBOX_RETRY_DELAY", 60)
+
+logger = logging.getLogger(__name__)
+
+
+def claim(limit=BATCH_SIZE):
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutgoingEmail.NEW, send_after__lte=now)
+            .order_by("send_after")
+            .values_list("id", flat=True)[:limit]
+        )
+        OutgoingEmail.objects.filter(id__in=ids).update(
+            status=OutgoingEmail.SENDING, attempts=F("attempts") + 1, date_updated=now
+        )
+    return list(OutgoingEmail.objects.filter(id__in=ids).order_by("send_after"))
+
+
+def requeue_stale(minutes=30):
+    """Возврат в очередь писем, зависших после падения обработчика"""
+    return OutgoingEmail.objects.filter(
+        status=OutgoingEmail.SENDING,
+        date_updated__lt=timezone.now() - timedelta(minutes=minutes),
+    ).update(status=OutgoingEmail.NEW)
+
+
+def retry_later(email, error):
+    if email.attempts >= MAX_ATTEMPTS:
+        status, send_after = OutgoingEmail.FAILED, email.send_after
+        logger.error("Письмо id %d не отправлено после %d попыток: %s", email.id, email.attempts, error)
+    else:
+        status = OutgoingEmail.NEW
+        send_after = timezone.now() + timedelta(seconds=RETRY_DELAY * 2 ** (email.attempts - 1))
+        logger.warning("Письмо id %d отложено до %s: %s", email.id, send_after, error)
+    OutgoingEmail.objects.filter(pk=email.pk).update(
+        status=status, send_after=send_after, last_error=error, date_updated=timezone.now()
+    )
+
+
+def send_pending(limit=BATCH_SIZE):
+    """Отправка одной пачки писем, возвращает число обработанных"""
+    emails = claim(limit)
+    if not emails:
+        return 0
+
+    sent = []
+    try:
+        with get_connection(fail_silently=False) as connection:
+            for email in emails:
+                message = EmailMessage(email.subject, email.body, email.from_email, email.to, connection=connection)
+                try:
+                    connection.send_messages([message])
+                except Exception as e:
+                    retry_later(email, repr(e))
+                else:
+                    sent.append(email.pk)
+    except Exception as e:
+        # соединение не открылось: вся неотправленная часть пачки откладывается
+        for email in emails:
+            if email.pk not in sent:
+                retry_later(email, repr(e))
+
+    now = timezone.now()
+    OutgoingEmail.objects.filter(pk__in=sent).update(
+        status=OutgoingEmail.SENT, date_sent=now, last_error="", date_updated=now
+    )
+    logger.info("Отправлено писем %d из %d", len(sent), len(emails))
+    return len(emails)
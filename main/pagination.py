@@ -0,0 +1,112 @@
+"""
+Постраничный вывод по ключу сортировки (keyset / seek pagination).
+
+Вместо OFFSET и COUNT(*) следующая страница выбирается условием
+"после последней записи текущей страницы", поэтому страница N стоит
+столько же, сколько первая. Курсоры подписаны и непрозрачны для клиента.
+"""
+import json
+from functools import reduce
+from operator import or_
+
+from django.core import signing
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import Q
+
+CURSOR_SALT = "main.pagination"
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    def __init__(self, queryset, per_page, ordering=("name", "id")):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+
+    def encode_cursor(self, obj, direction):
+        values = [getattr(obj, field) for field in self.ordering]
+        return signing.dumps([direction, values], salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, values = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, ValueError, TypeError):
+            raise InvalidPage("Invalid cursor")
+        if direction not in ("next", "prev") or len(values) != len(self.ordering):
+            raise InvalidPage("Invalid cursor")
+        return direction, values
+
+    def seek(self, values, lookup):
+        """Условие (f1, f2, ...) > (v1, v2, ...) для лексикографического порядка"""
+        conditions = []
+        for i, field in enumerate(self.ordering):
+            filters = dict(zip(self.ordering[:i], values[:i]))
+            filters["%s__%s" % (field, lookup)] = values[i]
+            conditions.append(Q(**filters))
+        return reduce(or_, conditions)
+
+    def _queryset(self, cursor):
+        direction, values = self.decode_cursor(cursor) if cursor else ("next", None)
+        queryset = self.queryset
+        if direction == "next":
+            if values:
+                queryset = queryset.filter(self.seek(values, "gt"))
+            queryset = queryset.order_by(*self.ordering)
+        else:
+            queryset = queryset.filter(self.seek(values, "lt"))
+            queryset = queryset.order_by(*("-%s" % field for field in self.ordering))
+        return direction, values, queryset[:self.per_page + 1]
+
+    def _page(self, rows, direction, values):
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == "prev":
+            rows.reverse()
+        if not rows:
+            return KeysetPage(rows)
+
+        has_next = has_more if direction == "next" else True
+        has_previous = has_more if direction == "prev" else bool(values)
+        return KeysetPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1], "next") if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], "prev") if has_previous else None,
+        )
+
+    def page(self, cursor=None):
+        direction, values, queryset = self._queryset(cursor)
+        return self._page(list(queryset), direction, values)
+
+    async def apage(self, cursor=None):
+        direction, values, queryset = self._queryset(cursor)
+        return self._page([obj async for obj in queryset], direction, values)
+
+    def approximate_count(self):
+        """Оценка числа записей по плану запроса PostgreSQL, иначе None"""
+        connection = connections[self.queryset.db]
+        if connection.vendor != "postgresql":
+            return None
+        plan = json.loads(self.queryset.order_by().explain(format="json"))
+        return plan[0]["Plan"]["Plan Rows"]
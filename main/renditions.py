@@ -0,0 +1,240 @@
+"""
+Фоновая генерация миниатюр и уменьшенных копий для фото товаров.
+
+Сохранение ProductImage только ставит задачу в очередь (таблица
+RenditionJob), а декодирование и уменьшение изображений выполняется
+пулом потоков внутри процесса веб-сервера или командой process_renditions
+с пулом процессов. Каждое исходное фото декодируется один раз,
+для JPEG сразу в уменьшенном масштабе через Image.draft().
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from io import BytesIO
+
+from PIL import Image, features
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Product, ProductImage, ProductImageRendition, RenditionJob
+
+THUMBNAIL_SIZE = (150, 150)
+RENDITIONS = getattr(settings, "PRODUCT_IMAGE_RENDITIONS", {
+    "list": (300, 300),
+    "detail": (600, 600),
+    "zoom": (1200, 1200),
+})
+RENDITION_FORMATS = getattr(settings, "PRODUCT_IMAGE_RENDITION_FORMATS", ("webp", "jpeg"))
+RENDITION_QUALITY = 82
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+_worker = None
+_worker_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def file_hash(field_file):
+    digest = hashlib.sha256()
+    with field_file.open("rb") as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def available_formats(formats=RENDITION_FORMATS):
+    return tuple(f for f in formats if f != "webp" or features.check("webp"))
+
+
+def render_renditions(data, sizes=RENDITIONS, formats=RENDITION_FORMATS):
+    """
+    Миниатюра и уменьшенные копии из байтов исходного фото,
+    выполняется в пуле. Возвращает байты миниатюры и список
+    (name, format, width, height, bytes).
+    """
+    image = Image.open(BytesIO(data))
+    all_sizes = list(sizes.values()) + [THUMBNAIL_SIZE]
+    image.draft("RGB", (max(w for w, h in all_sizes), max(h for w, h in all_sizes)))
+    image = image.convert("RGB")
+
+    renditions = []
+    previous = None
+    # от большего к меньшему: каждая копия уменьшается из предыдущей,
+    # размеры больше исходного не дублируются
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        image.thumbnail(size, Image.LANCZOS)
+        if image.size == previous:
+            continue
+        previous = image.size
+        for fmt in formats:
+            out = BytesIO()
+            image.save(out, fmt.upper(), quality=RENDITION_QUALITY)
+            renditions.append((name, fmt, image.width, image.height, out.getvalue()))
+
+    image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    temp_thumb = BytesIO()
+    image.save(temp_thumb, "JPEG")
+    return temp_thumb.getvalue(), renditions
+
+
+def _render_safe(data, sizes, formats):
+    try:
+        return render_renditions(data, sizes, formats), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def _save_renditions(image, thumbnail, renditions):
+    base = os.path.splitext(os.path.basename(image.image.name))[0]
+    image.thumbnail.save(image.image.name, ContentFile(thumbnail), save=False)
+    objs = []
+    for name, fmt, width, height, content in renditions:
+        rendition = ProductImageRendition(
+            product_image=image, name=name, format=fmt, width=width, height=height
+        )
+        ext = "jpg" if fmt == "jpeg" else fmt
+        rendition.image.save("%s-%s.%s" % (base, name, ext), ContentFile(content), save=False)
+        objs.append(rendition)
+    return objs
+
+
+def schedule(product_image):
+    """Постановка фото в очередь, если исходный файл изменился"""
+    source_hash = file_hash(product_image.image)
+    if source_hash == product_image.image_hash and product_image.thumbnail:
+        logger.debug("Фото id %d не изменилось, миниатюры актуальны", product_image.id)
+        return None
+
+    logger.info("Постановка в очередь миниатюр для продукта %d", product_image.product_id)
+    job, created = RenditionJob.objects.get_or_create(
+        product_image=product_image,
+        source_hash=source_hash,
+        status=RenditionJob.NEW,
+    )
+    transaction.on_commit(wake_background_worker)
+    return job
+
+
+def claim_jobs(limit=BATCH_SIZE):
+    with transaction.atomic():
+        ids = list(
+            RenditionJob.objects.select_for_update(skip_locked=True)
+            .filter(status=RenditionJob.NEW)
+            .order_by("id")
+            .values_list("id", flat=True)[:limit]
+        )
+        RenditionJob.objects.filter(id__in=ids).update(
+            status=RenditionJob.PROCESSING, attempts=F("attempts") + 1
+        )
+    return list(RenditionJob.objects.filter(id__in=ids).select_related("product_image"))
+
+
+def requeue_stale(minutes=30):
+    """Возврат в очередь задач, зависших после падения обработчика"""
+    return RenditionJob.objects.filter(
+        status=RenditionJob.PROCESSING,
+        date_updated__lt=timezone.now() - timedelta(minutes=minutes),
+    ).update(status=RenditionJob.NEW)
+
+
+def _read_source(job):
+    try:
+        with job.product_image.image.open("rb") as f:
+            return f.read(), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def _retry_or_fail(job, error):
+    status = RenditionJob.FAILED if job.attempts >= MAX_ATTEMPTS else RenditionJob.NEW
+    RenditionJob.objects.filter(pk=job.pk).update(status=status)
+    logger.error("Ошибка генерации миниатюр для фото id %d: %s", job.product_image_id, error)
+
+
+def process_pending(executor=None, limit=BATCH_SIZE):
+    """Обработка одной пачки задач, возвращает число обработанных"""
+    jobs = claim_jobs(limit)
+    if not jobs:
+        return 0
+
+    # недоступный исходный файл - ошибка только своей задачи, а не всей пачки
+    sources = [_read_source(job) for job in jobs]
+    mapper = executor.map if executor else map
+    render = partial(_render_safe, sizes=RENDITIONS, formats=available_formats())
+    results = iter(mapper(render, [data for data, error in sources if error is None]))
+
+    for job, (data, error) in zip(jobs, sources):
+        image = job.product_image
+        if error is None:
+            result, error = next(results)
+        if error:
+            _retry_or_fail(job, error)
+            continue
+
+        try:
+            objs = _save_renditions(image, *result)
+            old_files = list(image.renditions.values_list("image", flat=True))
+            with transaction.atomic():
+                image.renditions.all().delete()
+                ProductImageRendition.objects.bulk_create(objs)
+                ProductImage.objects.filter(pk=image.pk).update(
+                    thumbnail=image.thumbnail.name, image_hash=job.source_hash
+                )
+                RenditionJob.objects.filter(pk=job.pk).update(status=RenditionJob.DONE)
+                Product.objects.filter(pk=image.product_id).update(date_updated=timezone.now())
+        except Exception as e:
+            _retry_or_fail(job, repr(e))
+            continue
+        for name in set(old_files) - {r.image.name for r in objs}:
+            default_storage.delete(name)
+        logger.info("Сгенерированы миниатюры для продукта %d", image.product_id)
+    return len(jobs)
+
+
+def _run_worker():
+    workers = getattr(settings, "RENDITION_WORKERS", os.cpu_count())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            _wakeup.wait()
+            _wakeup.clear()
+            try:
+                # задачи, брошенные упавшим процессом, возвращаются и здесь
+                requeue_stale()
+                while process_pending(executor):
+                    pass
+            except Exception:
+                logger.exception("Ошибка фоновой генерации миниатюр")
+            finally:
+                close_old_connections()
+
+
+def start_background_worker(**kwargs):
+    """
+    Запуск фонового потока в процессе веб-сервера (RENDITIONS_IN_PROCESS),
+    подключен к сигналу request_started. Команды поток не запускают: он
+    погиб бы вместе с процессом, оставив задачи в PROCESSING, их очередь
+    обрабатывает process_renditions.
+    """
+    global _worker
+    if _worker is not None or not getattr(settings, "RENDITIONS_IN_PROCESS", True):
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name="renditions", daemon=True)
+            _worker.start()
+
+
+def wake_background_worker():
+    """Пробуждение фонового потока после коммита задач, если он запущен в этом процессе"""
+    if _worker is not None:
+        _wakeup.set()
@@ -0,0 +1,309 @@
+"""
+Полнотекстовый поиск по товарам на инвертированном индексе в памяти.
+
+Индекс строится по названию, описанию без HTML-разметки и названиям
+тэгов активных товаров, обновляется сигналами при сохранении и удалении
+товара (bulk-импорт вызывает reindex_products сам) и сохраняется на диск (SEARCH_INDEX_PATH).
+Из базы индекс строится только командой, процессы сайта его загружают:
+python manage.py rebuild_search_index
+
+Каждый процесс держит свою копию индекса. Запись файла идет под
+блокировкой: индекс перечитывается, к нему применяются еще не записанные
+изменения процесса, и только потом файл заменяется.
+"""
+import bisect
+import fcntl
+import logging
+import math
+import os
+import pickle
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.html import strip_tags
+
+logger = logging.getLogger(__name__)
+
+INDEX_PATH = getattr(settings, "SEARCH_INDEX_PATH", os.path.join(settings.BASE_DIR, "search.idx"))
+SAVE_INTERVAL = getattr(settings, "SEARCH_INDEX_SAVE_INTERVAL", 60)
+FIELD_WEIGHTS = {"name": 3.0, "tags": 2.0, "description": 1.0}
+MIN_PREFIX_LENGTH = 3
+PREFIX_PENALTY = 0.5
+
+TOKEN_RE = re.compile(r"\w+")
+# окончания, отбрасываемые у слов запроса на кириллице перед поиском по префиксу
+RUSSIAN_ENDINGS = sorted(
+    "ами ями ого его ому ему ыми ими ах ях ов ев ей ам ям ом ем ой ый ий ая яя ое ее ые ие ую юю ы и а я о е у ю ь".split(),
+    key=len,
+    reverse=True,
+)
+CYRILLIC_RE = re.compile(r"[а-я]")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def stem(token):
+    """Грубое отсечение русских окончаний, дальше слово ищется по префиксу"""
+    if len(token) <= 4 or not CYRILLIC_RE.match(token):
+        return token
+    for ending in RUSSIAN_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= 4:
+            return token[:-len(ending)]
+    return token
+
+
+class SearchIndex:
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.terms = []
+        self.terms_dirty = False
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def add(self, product_id, name, description, tags):
+        weights = defaultdict(float)
+        fields = (("name", name), ("description", strip_tags(description)), ("tags", " ".join(tags)))
+        for field, text in fields:
+            for token in tokenize(text):
+                weights[token] += FIELD_WEIGHTS[field]
+        with self.lock:
+            self.remove(product_id)
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    self.terms_dirty = True
+                self.postings[token][product_id] = weight
+            self.documents[product_id] = tuple(weights)
+            self.dirty = True
+
+    def remove(self, product_id):
+        with self.lock:
+            for token in self.documents.pop(product_id, ()):
+                postings = self.postings[token]
+                postings.pop(product_id, None)
+                if not postings:
+                    del self.postings[token]
+                    self.terms_dirty = True
+            self.dirty = True
+
+    def expand(self, token):
+        """Термины индекса для слова запроса: точное совпадение и по префиксу"""
+        prefix = stem(token)
+        if len(prefix) < MIN_PREFIX_LENGTH:
+            return [token] if token in self.postings else []
+        if self.terms_dirty:
+            self.terms = sorted(self.postings)
+            self.terms_dirty = False
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\uffff")
+        return self.terms[start:end]
+
+    def search(self, query):
+        """id товаров, содержащих все слова запроса, по убыванию релевантности"""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self.lock:
+            total = len(self.documents)
+            scores = None
+            for token in tokens:
+                token_scores = defaultdict(float)
+                for term in self.expand(token):
+                    postings = self.postings[term]
+                    idf = math.log(1 + total / len(postings))
+                    boost = 1.0 if term == token else PREFIX_PENALTY
+                    for product_id, weight in postings.items():
+                        token_scores[product_id] += weight * idf * boost
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {pid: score + token_scores[pid] for pid, score in scores.items() if pid in token_scores}
+                if not scores:
+                    return []
+        return sorted(scores, key=lambda pid: (-scores[pid], pid))
+
+    def save(self, path=INDEX_PATH):
+        with self.lock:
+            data = pickle.dumps({"postings": dict(self.postings), "documents": self.documents})
+            self.dirty = False
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        logger.info("Поисковый индекс сохранен, товаров %d", len(self.documents))
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        index = cls()
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        index.postings = defaultdict(dict, data["postings"])
+        index.documents = data["documents"]
+        index.terms_dirty = True
+        return index
+
+
+_index = None
+_index_mtime = None
+_last_save = 0
+_save_timer = None
+_index_lock = threading.RLock()
+# изменения этого процесса, еще не записанные в файл: id -> (название,
+# описание, тэги) или None для удаления; переносятся в индекс, перечитанный
+# с диска после записи другим процессом
+_pending = {}
+_missing_logged = False
+
+
+def build_index(products=None):
+    from .models import Product
+
+    if products is None:
+        products = Product.objects.active().prefetch_related("tags")
+    index = SearchIndex()
+    for product in products.iterator(chunk_size=2000):
+        index.add(product.id, product.name, product.description, [t.name for t in product.tags.all()])
+    return index
+
+
+def _replay_one(index, product_id, document):
+    if document is None:
+        index.remove(product_id)
+    else:
+        index.add(product_id, *document)
+
+
+def _replay(index):
+    for product_id, document in _pending.items():
+        _replay_one(index, product_id, document)
+
+
+def load_index():
+    """
+    Загрузка индекса с диска, если файл новее загруженного. Незаписанные
+    изменения этого процесса применяются к перечитанному индексу.
+    """
+    global _index, _index_mtime
+    try:
+        mtime = os.path.getmtime(INDEX_PATH)
+    except OSError:
+        return _index
+    if mtime != _index_mtime:
+        with _index_lock:
+            if mtime != _index_mtime:
+                index = SearchIndex.load(INDEX_PATH)
+                _replay(index)
+                _index = index
+                _index_mtime = mtime
+    return _index
+
+
+def get_index():
+    """
+    Индекс для поиска. Без файла индекса (не выполнена rebuild_search_index)
+    поиск пуст: построение из базы в запросе заняло бы его целиком.
+    """
+    global _missing_logged
+    index = load_index()
+    if index is None:
+        if not _missing_logged:
+            logger.warning("Поисковый индекс не найден, выполните rebuild_search_index")
+            _missing_logged = True
+        return SearchIndex()
+    return index
+
+
+def set_index(index):
+    global _index, _index_mtime
+    with _index_lock:
+        _index = index
+        _index_mtime = None
+        _pending.clear()
+
+
+@contextmanager
+def _file_lock():
+    """Запись файла индекса одним процессом за раз"""
+    with open("%s.lock" % INDEX_PATH, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_index(index):
+    """Запись индекса, построенного командой, поверх файла"""
+    global _index_mtime
+    with _file_lock(), _index_lock:
+        index.save(INDEX_PATH)
+        set_index(index)
+        _index_mtime = os.path.getmtime(INDEX_PATH)
+
+
+def save_index(force=False):
+    """
+    Сохранение индекса на диск не чаще SEARCH_INDEX_SAVE_INTERVAL. Под
+    блокировкой файла индекс сначала перечитывается, чтобы не затереть
+    изменения других процессов.
+    """
+    global _last_save, _index_mtime, _save_timer
+    if _index is None or not _pending:
+        return
+    wait = SAVE_INTERVAL - (time.monotonic() - _last_save)
+    if not force and wait > 0:
+        with _index_lock:
+            if _save_timer is None:
+                _save_timer = threading.Timer(wait, _deferred_save)
+                _save_timer.daemon = True
+                _save_timer.start()
+        return
+    with _file_lock(), _index_lock:
+        index = load_index()
+        index.save(INDEX_PATH)
+        _pending.clear()
+        _last_save = time.monotonic()
+        _index_mtime = os.path.getmtime(INDEX_PATH)
+
+
+def _deferred_save():
+    global _save_timer
+    _save_timer = None
+    save_index(force=True)
+
+
+def update_product(product):
+    """Изменение товара в индексе процесса; без файла индекса ничего не делается"""
+    index = load_index()
+    if index is None:
+        return
+    document = None
+    if product.active:
+        document = (product.name, product.description, [t.name for t in product.tags.all()])
+    with _index_lock:
+        _pending[product.id] = document
+        _replay_one(index, product.id, document)
+
+
+def reindex_products(product_ids):
+    """Переиндексация товаров из базы, неактивные убираются из индекса"""
+    from .models import Product
+
+    for product in Product.objects.filter(id__in=product_ids).prefetch_related("tags"):
+        update_product(product)
+    save_index()
+
+
+def remove_product(product_id):
+    index = load_index()
+    if index is None:
+        return
+    with _index_lock:
+        _pending[product_id] = None
+        index.remove(product_id)
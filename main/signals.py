@@ -1,52 +1,179 @@
-from io import BytesIO
 import logging
-from PIL import Image
 from django.contrib.auth import user_logged_in
-from django.core.files.base import ContentFile
-from django.db.models.signals import pre_save
+from django.core.signals import request_started
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
-from .models import ProductImage, Basket
+from . import caching, renditions, search
+from .models import Product, ProductImage, ProductTag, Basket, BasketLine, StockHold, Order, OrderLine
 
-THUMBNAIL_SIZE = (150, 150)
 logger = logging.getLogger(__name__)
 
+# фоновый поток миниатюр только в процессах, обслуживающих запросы
+request_started.connect(renditions.start_background_worker, dispatch_uid="main.renditions.worker")
 
-@receiver(pre_save, sender=ProductImage)
-def generate_thumbnail(sender, instance, **kwargs):
-    logger.info("Генерация миниатюр для продукта %d", instance.product.id)
 
-    image = Image.open(instance.image)
-    image = image.convert("RGB")
-    image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-    temp_thumb = BytesIO()
-    image.save(temp_thumb, "JPEG")
-    temp_thumb.seek(0)
+@receiver(post_save, sender=ProductImage)
+def queue_thumbnail(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    renditions.schedule(instance)
+    Product.objects.filter(pk=instance.product_id).update(date_updated=timezone.now())
 
-    # set save=False, в противном случае он будет работать в бесконечном цикле
-    instance.thumbnail.save(instance.image.name, ContentFile(temp_thumb.read()), save=False)
-    temp_thumb.close()
+
+@receiver(post_delete, sender=ProductImage)
+def touch_product_on_image_delete(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id).update(date_updated=timezone.now())
+
+
+def _reindex_products(product_ids):
+    transaction.on_commit(lambda: search.reindex_products(product_ids))
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    _reindex_products([instance.id])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_id = instance.id
+
+    def unindex():
+        search.remove_product(product_id)
+        search.save_index()
+    transaction.on_commit(unindex)
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def reindex_product_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        _reindex_products([instance.id])
+    elif pk_set:
+        _reindex_products(list(pk_set))
+
+
+@receiver(post_save, sender=ProductTag)
+def reindex_tag_products(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    _reindex_products(list(instance.product_set.values_list("id", flat=True)))
+
+
+def _bump_catalog(tag_slugs):
+    # сразу и после коммита: иначе конкурентный запрос может успеть
+    # построить фрагмент по старым данным под новой версией
+    tag_slugs = list(tag_slugs)
+    caching.bump_versions(tag_slugs)
+    transaction.on_commit(lambda: caching.bump_versions(tag_slugs))
+
+
+@receiver(post_save, sender=Product)
+@receiver(pre_delete, sender=Product)
+def bump_product_catalog(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    _bump_catalog(instance.tags.values_list("slug", flat=True))
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def bump_product_tags_catalog(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if reverse:
+        _bump_catalog([instance.slug])
+    elif action == "pre_clear":
+        _bump_catalog(instance.tags.values_list("slug", flat=True))
+    else:
+        _bump_catalog(ProductTag.objects.filter(pk__in=pk_set).values_list("slug", flat=True))
+
+
+@receiver(post_save, sender=ProductTag)
+@receiver(post_delete, sender=ProductTag)
+def bump_tag_catalog(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    _bump_catalog([instance.slug])
+
+
+@receiver(post_save, sender=Basket)
+@receiver(post_delete, sender=Basket)
+def invalidate_basket_cache(sender, instance, **kwargs):
+    instance.invalidate_cache()
+
+
+@receiver(pre_delete, sender=Basket)
+def release_basket_holds(sender, instance, **kwargs):
+    StockHold.objects.release(instance)
+
+
+@receiver(post_save, sender=BasketLine)
+@receiver(post_delete, sender=BasketLine)
+def invalidate_basketline_cache(sender, instance, **kwargs):
+    cache.delete(Basket.cache_key(instance.basket_id))
+
+
+@receiver(post_save, sender=OrderLine)
+def update_order_summary(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    loaded = getattr(instance, "_loaded", None)
+    current = (instance.status, instance.quantity, instance.product_id, instance.unit_price)
+    if created or loaded is None or None in loaded or loaded[1:] != current[1:]:
+        Order(pk=instance.order_id).update_summary()
+    elif loaded != current:
+        # смена только статуса: сдвиг счетчиков без пересчета строк заказа
+        old_status, old_quantity = loaded[:2]
+        old_field = OrderLine.STATUS_COUNTERS[old_status]
+        new_field = OrderLine.STATUS_COUNTERS[instance.status]
+        Order.objects.filter(pk=instance.order_id).update(**{
+            old_field: F(old_field) - old_quantity,
+            new_field: F(new_field) + instance.quantity,
+        })
+    instance._loaded = current
+
+
+@receiver(post_delete, sender=OrderLine)
+def update_order_summary_on_delete(sender, instance, origin=None, **kwargs):
+    # при удалении самого заказа сводка не нужна
+    if isinstance(origin, Order):
+        return
+    Order(pk=instance.order_id).update_summary()
 
 
 @receiver(user_logged_in)
 def merge_baskets_if_found(sender, user, request, **kwargs):
     anonymous_basket = getattr(request, "basket", None)
     if anonymous_basket:
-        try:
-            loggedin_basket = Basket.objects.get(
-                user=user, status=Basket.OPEN
+        with transaction.atomic():
+            # блокировки строк корзин: параллельные входы одного пользователя
+            # объединяют корзины последовательно
+            open_baskets = list(
+                Basket.objects.select_for_update()
+                .filter(Q(user=user, status=Basket.OPEN) | Q(pk=anonymous_basket.pk))
+                .order_by("id")
             )
-            for line in anonymous_basket.basketline_set.all():
-                line.basket = loggedin_basket
-                line.save()
-            anonymous_basket.delete()
-            request.basket = loggedin_basket
-            logger.info(
-                "Объединенная корзина для id %d", loggedin_basket.id
-            )
-        except Basket.DoesNotExist:
-            anonymous_basket.user = user
-            anonymous_basket.save()
-            logger.info(
-                "Добавлен пользователь в корзину id %d",
-                anonymous_basket.id,
-            )
\ No newline at end of file
+            user_baskets = [b for b in open_baskets if b.user_id == user.id and b.status == Basket.OPEN]
+            if not user_baskets:
+                anonymous_basket.user = user
+                anonymous_basket.save(update_fields=["user"])
+                logger.info(
+                    "Добавлен пользователь в корзину id %d",
+                    anonymous_basket.id,
+                )
+                return
+
+            loggedin_basket = user_baskets[0]
+            loggedin_basket.merge([b for b in open_baskets if b.pk != loggedin_basket.pk])
+        request.basket = loggedin_basket
+        request.session["basket_id"] = loggedin_basket.id
+        logger.info(
+            "Объединенная корзина для id %d", loggedin_basket.id
+        )
@@ -0,0 +1,89 @@
+import json
+from decimal import Decimal
+
+from django.test import TestCase
+from django.urls import reverse
+
+from main import models
+
+
+class TestApi(TestCase):
+    """Тест JSON API каталога"""
+    def setUp(self):
+        self.cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        self.cb.tags.create(name="Open source", slug="opensource")
+        for i in range(3):
+            models.Product.objects.create(name="Book %d" % i, slug="book-%d" % i, price=Decimal("2.00"))
+        models.Product.objects.create(name="Hidden", slug="hidden", price=Decimal("2.00"), active=False)
+
+    def test_product_list_fields_and_cursor(self):
+        response = self.client.get(reverse("api_product_list"), {"fields": "id,name,price", "limit": 3})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["results"][0], {"id": self.cb.id, "name": "The cathedral and the bazaar", "price": "10.00"})
+        self.assertEqual(len(data["results"]), 3)
+
+        response = self.client.get(reverse("api_product_list"), {"fields": "slug", "limit": 3, "cursor": data["next"]})
+        data = response.json()
+        self.assertEqual(data["results"], [{"slug": "book-2"}])
+        self.assertIsNone(data["next"])
+
+        response = self.client.get(reverse("api_product_list"), {"tag": "opensource"})
+        self.assertEqual([p["tags"] for p in response.json()["results"]], [["opensource"]])
+
+        response = self.client.get(reverse("api_product_list"), {"fields": "password"})
+        self.assertEqual(response.status_code, 400)
+
+        for limit, count in ((-5, 1), (0, 1), (10000, 4)):
+            response = self.client.get(reverse("api_product_list"), {"limit": limit})
+            self.assertEqual(len(response.json()["results"]), count)
+
+    def test_product_detail_and_conditional_requests(self):
+        url = reverse("api_product_detail", kwargs={"slug": "cathedral-bazaar"})
+        response = self.client.get(url)
+        self.assertEqual(response.json()["images"], [])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        for name in ("api_product_detail", "api_product_images"):
+            response = self.client.get(reverse(name, kwargs={"slug": "hidden"}))
+            self.assertEqual(response.status_code, 404)
+
+        url = reverse("api_tag_list")
+        response = self.client.get(url)
+        self.assertEqual(response.json()["results"][0]["slug"], "opensource")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_in_stock_revalidates_after_reservation(self):
+        models.Product.objects.filter(pk=self.cb.pk).update(stock=1)
+        detail_url = reverse("api_product_detail", kwargs={"slug": "cathedral-bazaar"})
+        list_params = {"fields": "id,in_stock", "limit": 1}
+        detail_etag = self.client.get(detail_url)["ETag"]
+        list_etag = self.client.get(reverse("api_product_list"), list_params)["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Basket.objects.create().add_product(models.Product.objects.get(pk=self.cb.pk))
+
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()["in_stock"])
+        response = self.client.get(reverse("api_product_list"), list_params, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], [{"id": self.cb.id, "in_stock": False}])
+
+    def test_product_export_streams_jsonl(self):
+        response = self.client.get(reverse("api_product_export"), {"fields": "slug,tags"}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+        response = self.client.get(reverse("api_product_export"), {"fields": "slug,tags"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [
+                {"slug": "cathedral-bazaar", "tags": ["opensource"]},
+                {"slug": "book-0", "tags": []},
+                {"slug": "book-1", "tags": []},
+                {"slug": "book-2", "tags": []},
+            ],
+        )
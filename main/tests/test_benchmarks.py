@@ -0,0 +1,192 @@
+"""
+Бенчмарк маршрутов main/urls.py и списков админки.
+
+Каталог из тысяч товаров засевается командой generate_catalog, поэтому
+N+1 сразу виден в числе запросов: для каждого маршрута задан потолок,
+он проверяется при каждом запуске тестов. Время ответа (p50/p95) зависит
+от машины, поэтому сравнивается с локальным файлом BENCHMARK_BASELINE
+только с BENCHMARK_LATENCY=1; первый такой запуск или BENCHMARK_UPDATE=1
+записывает базу заново. Запуск только бенчмарков со сравнением времени:
+BENCHMARK_LATENCY=1 python manage.py test main --tag benchmark
+"""
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+
+from django.conf import settings
+from django.contrib import admin
+from django.db import connection
+from django.core.management import call_command
+from django.test import TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from main import models, search, urls
+
+PRODUCTS = 2000
+TAGS = 50
+COVERS = 2
+ORDERS = 20
+ORDER_LINES = 100
+BASKET_LINES = 50
+REPEAT = 5
+
+BASELINE_PATH = getattr(settings, "BENCHMARK_BASELINE", os.path.join(settings.BASE_DIR, "benchmark-baseline.json"))
+CHECK_LATENCY = os.environ.get("BENCHMARK_LATENCY") == "1"
+# допустимое замедление относительно базы и абсолютный запас на шум
+THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", 0.5))
+SLACK_MS = 5.0
+
+# маршрут: (метод, аргументы, пользователь, потолок запросов);
+# add_to_basket - новый для корзины товар с учетом остатка: вставка строки
+# и резерва в точках сохранения
+ROUTES = {
+    "home": ("get", {}, None, 0),
+    "about_us": ("get", {}, None, 0),
+    "contact_us": ("get", {}, None, 0),
+    "login": ("get", {}, None, 0),
+    "signup": ("get", {}, None, 0),
+    "products": ("get", {"tag": "all"}, None, 1),
+    "product": ("get", {"slug": None}, None, 5),
+    "search": ("get", {}, None, 1),
+    "basket": ("get", {}, "user", 4),
+    "add_to_basket": ("get", {}, "user", 14),
+    "add_to_basket_json": ("post", {}, "user", 10),
+    "basket_summary": ("get", {}, "user", 2),
+    "address_select": ("get", {}, "user", 5),
+    "checkout_done": ("get", {}, "user", 1),
+    "address_list": ("get", {}, "user", 3),
+    "address_create": ("get", {}, "user", 2),
+    "address_update": ("get", {"pk": None}, "user", 3),
+    "address_delete": ("get", {"pk": None}, "user", 3),
+    "metrics": ("get", {}, "admin", 2),
+    "api_product_list": ("get", {}, None, 2),
+    "api_product_detail": ("get", {"slug": None}, None, 3),
+    "api_product_images": ("get", {"slug": None}, None, 2),
+    "api_tag_list": ("get", {}, None, 1),
+    "api_product_export": ("get", {}, None, 2),
+}
+ROUTE_PARAMS = {
+    "search": {"q": "river"},
+    "add_to_basket": {"product_id": None},
+    "add_to_basket_json": {"product_id": None},
+    "api_product_list": {"fields": "id,name,price,in_stock,tags", "limit": 100},
+}
+ADMIN_MAX_QUERIES = 6
+
+
+@tag("benchmark")
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class BenchmarkTest(TestCase):
+    """Число запросов и время ответа маршрутов на большом каталоге"""
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            "generate_catalog", "--products", PRODUCTS, "--tags", TAGS, "--covers", COVERS, stdout=StringIO(),
+        )
+        cls.products = list(models.Product.objects.order_by("id"))
+        # товары заказов без учета остатка, чтобы оформление не упиралось в случайный остаток
+        models.Product.objects.filter(id__lte=cls.products[ORDERS + ORDER_LINES].id).update(stock=None)
+        # товар с учетом остатка: добавление в корзину ставит резерв
+        cls.product = models.Product.objects.filter(stock__gte=REPEAT * 2).order_by("id").first()
+        cls.user = models.User.objects.create_user("user@a.com", "pw432joij")
+        cls.admin = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        cls.address = models.Address.objects.create(
+            user=cls.user, name="John Kimball", address1="127 Strudel road", city="London", country="uk",
+        )
+        basket = models.Basket.objects.create(user=cls.user)
+        models.BasketLine.objects.bulk_create(
+            models.BasketLine(basket=basket, product=p, quantity=2) for p in cls.products[:BASKET_LINES]
+        )
+        basket.update_counts()
+        cls.basket = basket
+        for i in range(ORDERS):
+            order_basket = models.Basket.objects.create(user=cls.user)
+            models.BasketLine.objects.bulk_create(
+                models.BasketLine(basket=order_basket, product=p) for p in cls.products[i:i + ORDER_LINES]
+            )
+            order_basket.create_order(cls.address, cls.address)
+        search.set_index(search.build_index())
+
+    @classmethod
+    def tearDownClass(cls):
+        search.set_index(search.SearchIndex())
+        super().tearDownClass()
+
+    def login(self, who):
+        if who == "user":
+            self.client.force_login(self.user)
+            session = self.client.session
+            session["basket_id"] = self.basket.id
+            session.save()
+        elif who == "admin":
+            self.client.force_login(self.admin)
+
+    def route_url(self, name, kwargs):
+        values = {"pk": self.address.pk, "slug": self.products[PRODUCTS // 2].slug}
+        return reverse(name, kwargs={k: values[k] if v is None else v for k, v in kwargs.items()})
+
+    def measure(self, method, url, params):
+        timings, max_queries = [], 0
+        for i in range(REPEAT):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = getattr(self.client, method)(url, params)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+                timings.append((time.perf_counter() - start) * 1000)
+            self.assertLess(response.status_code, 400, url)
+            max_queries = max(max_queries, len(queries))
+        timings.sort()
+        return max_queries, {
+            "p50": round(timings[len(timings) // 2], 2),
+            "p95": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        }
+
+    def check_baseline(self, results):
+        update = os.environ.get("BENCHMARK_UPDATE") == "1" or not os.path.exists(BASELINE_PATH)
+        if update:
+            with open(BASELINE_PATH, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            return
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        for name, timing in results.items():
+            if name not in baseline:
+                continue
+            limit = baseline[name]["p50"] * (1 + THRESHOLD) + SLACK_MS
+            with self.subTest(route=name):
+                self.assertLessEqual(
+                    timing["p50"], limit,
+                    "%s p50 %.1f мс, база %.1f мс" % (name, timing["p50"], baseline[name]["p50"]),
+                )
+
+    def test_every_route_is_benchmarked(self):
+        names = {pattern.name for pattern in urls.urlpatterns if pattern.name}
+        self.assertEqual(names - set(ROUTES), set())
+
+    def test_routes_and_admin_changelists(self):
+        results = {}
+        product_id = self.product.id
+        for name, (method, kwargs, who, max_queries) in ROUTES.items():
+            self.client.logout()
+            self.login(who)
+            params = {k: product_id if v is None else v for k, v in ROUTE_PARAMS.get(name, {}).items()}
+            queries, results[name] = self.measure(method, self.route_url(name, kwargs), params)
+            with self.subTest(route=name):
+                self.assertLessEqual(queries, max_queries, "%s: %d запросов" % (name, queries))
+
+        self.client.logout()
+        self.login("admin")
+        for model in admin.site._registry:
+            if model._meta.app_label != "main":
+                continue
+            name = "admin:main_%s_changelist" % model._meta.model_name
+            queries, results[name] = self.measure("get", reverse(name), {})
+            with self.subTest(route=name):
+                self.assertLessEqual(queries, ADMIN_MAX_QUERIES, "%s: %d запросов" % (name, queries))
+
+        if CHECK_LATENCY:
+            self.check_baseline(results)
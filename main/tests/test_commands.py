@@ -0,0 +1,50 @@
+from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command
+from django.test import TestCase
+
+from main import models
+
+
+class TestCommands(TestCase):
+    """Тест служебных команд"""
+    def test_explain_queries_uses_indexes(self):
+        out = StringIO()
+        call_command("explain_queries", stdout=out)
+        output = out.getvalue()
+        self.assertIn("Queries explained=10", output)
+        for name in ("product detail by slug", "tag by slug", "product list", "open basket by user"):
+            self.assertRegex(output, r"%s\s+ok" % name)
+
+    def test_backfill_order_totals(self):
+        user1 = models.User.objects.create_user("user1", "pw432joij")
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"))
+        p2 = models.Product.objects.create(name="Pride and Prejudice", price=Decimal("2.00"))
+        orders = []
+        for i in range(3):
+            order = models.Order.objects.create(user=user1)
+            models.OrderLine.objects.bulk_create([
+                models.OrderLine(order=order, product=p1, quantity=2),
+                models.OrderLine(order=order, product=p2),
+            ])
+            orders.append(order)
+        models.OrderLine.objects.filter(order=orders[0], product=p2).update(status=models.OrderLine.SENT)
+        empty = models.Order.objects.create(user=user1)
+        snapshotted = models.Order.objects.create(user=user1, total=Decimal("5.00"))
+
+        out = StringIO()
+        call_command("backfill_order_totals", "--chunk-size", "2", stdout=out)
+        self.assertIn("Backfilled orders=4 lines=6 summaries=5", out.getvalue())
+        for order in orders:
+            order.refresh_from_db()
+            self.assertEqual(order.total, Decimal("22.00"))
+            self.assertEqual((order.lines_count, order.items_count, order.products_count), (2, 3, 2))
+        self.assertEqual((orders[0].new_count, orders[0].sent_count), (2, 1))
+        self.assertEqual((orders[1].new_count, orders[1].sent_count), (3, 0))
+        self.assertEqual(
+            set(models.OrderLine.objects.values_list("line_total", flat=True)),
+            {Decimal("20.00"), Decimal("2.00")},
+        )
+        empty.refresh_from_db()
+        snapshotted.refresh_from_db()
+        self.assertEqual((empty.total, snapshotted.total), (0, Decimal("5.00")))
@@ -49,7 +49,7 @@ class FrontendTests(StaticLiveServerTestCase):
             )
         )
         current_image = self.selenium.find_element_by_css_selector(
-            ".current-image > img:nth-child(1)"
+            ".current-image > picture > img"
         ).get_attribute(
             "src"
         )
@@ -57,6 +57,6 @@ class FrontendTests(StaticLiveServerTestCase):
             "div.image:nth-child(3) > img:nth-child(1)"
         ).click()
         new_image = self.selenium.find_element_by_css_selector(
-            ".current-image > img:nth-child(1)"
+            ".current-image > picture > img"
         ).get_attribute("src")
         self.assertNotEqual(current_image, new_image)
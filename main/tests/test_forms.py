@@ -1,6 +1,9 @@
+from unittest.mock import patch
+
 from django.test import TestCase
+from django.utils import timezone
 from django.core import mail
-from main import forms
+from main import forms, models, outbox
 
 
 class TestForm(TestCase):
@@ -14,6 +17,9 @@ class TestForm(TestCase):
         })
         self.assertTrue(form.is_valid())
         with self.assertLogs('main.forms', level='INFO') as cm: form.send_mail()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(models.OutgoingEmail.objects.count(), 1)
+        outbox.send_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].subject, 'Сообщение с сайта')
         self.assertGreaterEqual(len(cm.output), 1)
@@ -36,6 +42,28 @@ class TestForm(TestCase):
         self.assertTrue(form.is_valid())
         with self.assertLogs("main.forms", level="INFO") as cm:
             form.send_mail()
+            form.send_mail()
+        self.assertEqual(models.OutgoingEmail.objects.count(), 1)
+        outbox.send_pending()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].subject, "Добро пожаловать в BookTime")
-        self.assertGreaterEqual(len(cm.output), 1)
\ No newline at end of file
+        self.assertGreaterEqual(len(cm.output), 1)
+
+        form.send_mail()
+        self.assertEqual(models.OutgoingEmail.objects.count(), 2)
+
+    def test_outbox_retries_with_backoff(self):
+        email, created = models.OutgoingEmail.objects.enqueue("Тема", "Текст", "site@booktime.domain", ["a@b.com"])
+        with patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=OSError("smtp down")):
+            with self.assertLogs("main.outbox", level="WARNING"):
+                self.assertEqual(outbox.send_pending(), 1)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (models.OutgoingEmail.NEW, 1))
+        self.assertGreater(email.send_after, timezone.now())
+        self.assertEqual(outbox.send_pending(), 0)
+
+        models.OutgoingEmail.objects.update(send_after=timezone.now())
+        self.assertEqual(outbox.send_pending(), 1)
+        email.refresh_from_db()
+        self.assertEqual(email.status, models.OutgoingEmail.SENT)
+        self.assertEqual(len(mail.outbox), 1)
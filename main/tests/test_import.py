@@ -1,13 +1,41 @@
+import csv
+import json
+from decimal import Decimal
 from io import StringIO
+import os.path
 import tempfile
+from unittest.mock import patch
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
 from django.test import TestCase, override_settings
-from main import models
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from main import caching, models, search
+from main.management.commands import generate_catalog
 
 
 class TestImport(TestCase):
     """Тест импортов"""
+    def setUp(self):
+        # импорт обновляет поисковый индекс, файл индекса - во временном каталоге;
+        # фоновый обработчик миниатюр после коммита в тестах не запускается
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        targets = (
+            ("main.search.INDEX_PATH", os.path.join(tmp.name, "search.idx")),
+            ("main.search.SAVE_INTERVAL", 0),
+            ("main.renditions.wake_background_worker", lambda: None),
+        )
+        for target, value in targets:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        search.set_index(search.SearchIndex())
+        self.addCleanup(search.set_index, search.SearchIndex())
+
     @override_settings(MEDIA_ROOT=tempfile.gettempdir())
     def test_import_data(self):
         out = StringIO()
@@ -17,8 +45,240 @@ class TestImport(TestCase):
         expected_out = ("Importing products\n"
                         "Products processed=3 (created=3)\n"
                         "Tags processed=6 (created=6)\n"
-                        "Images processed=3\n")
+                        "Images processed=3\n"
+                        "Run process_renditions to generate thumbnails for the imported images\n")
+        self.assertEqual(out.getvalue(), expected_out)
+        self.assertEqual(models.Product.objects.count(), 3)
+        self.assertEqual(models.ProductTag.objects.count(), 6)
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_import_data_reimport_updates_by_slug(self):
+        args = ['main/fixtures/product-sample.csv', 'main/fixtures/product-sampleimages/']
+        call_command('import_data', *args, stdout=StringIO())
+        with open('main/fixtures/product-sample.csv') as f:
+            lines = f.read().splitlines()
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as feed:
+            feed.write("\n".join([lines[0], lines[1].replace(",10.00", ",11.00"),
+                                  "Война и мир,Роман,Роман|Классика,siddhartha.jpg,9.00"]) + "\n")
+        out = StringIO()
+        call_command('import_data', feed.name, args[1], stdout=out)
+        os.remove(feed.name)
+        self.assertIn("Products processed=2 (created=1)\n", out.getvalue())
+        self.assertEqual(models.Product.objects.count(), 4)
+        self.assertEqual(models.Product.objects.get(slug="the-cathedral-and-the-bazaar").price, Decimal("11.00"))
+        product = models.Product.objects.get(slug="voina-i-mir")
+        self.assertEqual(sorted(product.tags.values_list("slug", flat=True)), ["klassika", "roman"])
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_import_data_stream(self):
+        out = StringIO()
+        args = ['main/fixtures/product-sample.csv',
+                'main/fixtures/product-sampleimages/',
+                '--stream', '--chunk-size', '2']
+        versions = {slug: caching.get_version(slug) for slug in ("all", "religion")}
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_data', *args, stdout=out)
+        expected_out = ("Importing products\n"
+                        "Products processed=3 (created=3)\n"
+                        "Tags processed=6 (created=6)\n"
+                        "Images processed=3\n"
+                        "Run process_renditions to generate thumbnails for the imported images\n")
         self.assertEqual(out.getvalue(), expected_out)
         self.assertEqual(models.Product.objects.count(), 3)
         self.assertEqual(models.ProductTag.objects.count(), 6)
-        self.assertEqual(models.ProductImage.objects.count(), 3)
\ No newline at end of file
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+        self.assertEqual(models.RenditionJob.objects.count(), 3)
+        for slug, version in versions.items():
+            self.assertNotEqual(caching.get_version(slug), version)
+        product = models.Product.objects.get(slug="siddhartha")
+        self.assertEqual(sorted(product.tags.values_list("slug", flat=True)), ["narrative", "religion"])
+        self.assertFalse(models.ImportCheckpoint.objects.exists())
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_import_data_stream_non_latin_names(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as feed:
+            feed.write(
+                "name,description,tags,image_filename,price\n"
+                "Война и мир,Роман,Роман|Классика,siddhartha.jpg,9.00\n"
+                "Анна Каренина,Роман,Роман|Драма,siddhartha.jpg,8.00\n"
+                "Война и мир!,Повтор,Роман,siddhartha.jpg,7.00\n"
+                "???,Без названия,Роман,siddhartha.jpg,1.00\n"
+            )
+        out, err = StringIO(), StringIO()
+        call_command('import_data', feed.name, 'main/fixtures/product-sampleimages/',
+                     '--stream', '--chunk-size', '2', stdout=out, stderr=err)
+        os.remove(feed.name)
+        self.assertIn("Products processed=2 (created=2)\n", out.getvalue())
+        self.assertIn("Rows skipped=2\n", out.getvalue())
+        self.assertIn("Row 4 skipped: duplicate slug 'voina-i-mir'", err.getvalue())
+        self.assertIn("Row 5 skipped: no slug for name '???'", err.getvalue())
+        self.assertEqual(
+            sorted(models.Product.objects.values_list("slug", "price")),
+            [("anna-karenina", Decimal("8.00")), ("voina-i-mir", Decimal("9.00"))],
+        )
+        self.assertEqual(sorted(models.ProductTag.objects.values_list("slug", flat=True)), ["drama", "klassika", "roman"])
+        self.assertEqual(self.client.get(reverse("products", kwargs={"tag": "all"})).status_code, 200)
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_import_data_stream_resumes(self):
+        csvfile = os.path.abspath('main/fixtures/product-sample.csv')
+        models.ImportCheckpoint.objects.create(source=csvfile, rows_committed=2)
+        out = StringIO()
+        args = [csvfile, 'main/fixtures/product-sampleimages/', '--stream', '--resume']
+        call_command('import_data', *args, stdout=out)
+        self.assertIn("Resuming after row 2\n", out.getvalue())
+        self.assertEqual(list(models.Product.objects.values_list("slug", flat=True)), ["backgammon-for-dummies"])
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_import_data_incremental(self):
+        args = ['main/fixtures/product-sample.csv',
+                'main/fixtures/product-sampleimages/',
+                '--incremental']
+        out = StringIO()
+        call_command('import_data', *args, stdout=out)
+        self.assertIn("Rows added=3 updated=0 unchanged=0 removed=0\n", out.getvalue())
+
+        out = StringIO()
+        call_command('import_data', *args, stdout=out)
+        self.assertIn("Products processed=0 (created=0)\n", out.getvalue())
+        self.assertIn("Rows added=0 updated=0 unchanged=3 removed=0\n", out.getvalue())
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+
+        with open('main/fixtures/product-sample.csv') as f:
+            lines = f.read().splitlines()
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as feed:
+            feed.write("\n".join([lines[0], lines[1].replace(",10.00", ",11.00"), lines[2]]) + "\n")
+        out = StringIO()
+        call_command('import_data', feed.name, 'main/fixtures/product-sampleimages/',
+                     '--incremental', '--deactivate-missing', stdout=out)
+        self.assertIn("Rows added=0 updated=1 unchanged=1 removed=1\n", out.getvalue())
+        self.assertEqual(models.Product.objects.count(), 3)
+        self.assertEqual(models.Product.objects.get(slug="the-cathedral-and-the-bazaar").price, Decimal("11.00"))
+        self.assertFalse(models.Product.objects.get(slug="backgammon-for-dummies").active)
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+
+        # пропавший товар учтен один раз
+        out = StringIO()
+        call_command('import_data', feed.name, 'main/fixtures/product-sampleimages/',
+                     '--incremental', '--deactivate-missing', stdout=out)
+        os.remove(feed.name)
+        self.assertIn("Rows added=0 updated=0 unchanged=2 removed=0\n", out.getvalue())
+
+        old_image = models.ProductImage.objects.get(product__slug="backgammon-for-dummies").image.name
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_data', *args, '--deactivate-missing', stdout=out)
+        self.assertIn("Rows added=0 updated=2 unchanged=1 removed=0\n", out.getvalue())
+        self.assertTrue(models.Product.objects.get(slug="backgammon-for-dummies").active)
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+        self.assertFalse(default_storage.exists(old_image))
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_import_data_incremental_updates_search_index(self):
+        args = ['main/fixtures/product-sample.csv', 'main/fixtures/product-sampleimages/', '--incremental']
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_data', *args, stdout=StringIO())
+        siddhartha = models.Product.objects.get(slug="siddhartha")
+        self.assertEqual(search.get_index().search("hesse"), [siddhartha.id])
+
+        with open('main/fixtures/product-sample.csv') as f:
+            lines = f.read().splitlines()
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as feed:
+            feed.write("\n".join([lines[0], lines[1]]) + "\n")
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_data', feed.name, args[1], '--incremental', '--deactivate-missing', stdout=StringIO())
+        os.remove(feed.name)
+        self.assertEqual(search.get_index().search("hesse"), [])
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_export_data_round_trips_import_layout(self):
+        call_command('import_data', 'main/fixtures/product-sample.csv',
+                     'main/fixtures/product-sampleimages/', stdout=StringIO())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.csv")
+            out = StringIO()
+            call_command('export_data', path, stdout=out)
+            self.assertEqual(out.getvalue(), "Exporting products\nProducts exported=3\n")
+            with open(path) as f:
+                exported = list(csv.DictReader(f))
+            with open('main/fixtures/product-sample.csv') as f:
+                original = list(csv.DictReader(f))
+
+            def normalize(rows):
+                return sorted(
+                    (r["name"], r["description"], frozenset(r["tags"].split("|")), r["price"])
+                    for r in rows
+                )
+            self.assertEqual(normalize(exported), normalize(original))
+            # хранилище может добавить суффикс к имени файла
+            for row in exported:
+                self.assertTrue(row["image_filename"].endswith(".jpg"))
+
+            path = os.path.join(tmp, "export.jsonl")
+            call_command('export_data', path, '--format', 'jsonl', stdout=StringIO())
+            with open(path) as f:
+                rows = [json.loads(line) for line in f]
+            self.assertEqual(rows[1]["slug"], "siddhartha")
+            self.assertEqual(sorted(rows[1]["tags"]), ["Narrative", "Religion"])
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_generate_catalog(self):
+        out = StringIO()
+        call_command(
+            "generate_catalog", "--products", "30", "--tags", "5", "--covers", "2",
+            "--users", "3", "--baskets", "2", "--orders", "4", "--batch-size", "7", stdout=out,
+        )
+        self.assertIn("Products created=30", out.getvalue())
+        self.assertEqual(models.Product.objects.count(), 30)
+        self.assertEqual(models.ProductTag.objects.count(), 5)
+        self.assertEqual(models.ProductImage.objects.count(), 30)
+        self.assertEqual(models.RenditionJob.objects.filter(status=models.RenditionJob.NEW).count(), 30)
+        self.assertEqual(models.Address.objects.count(), 3)
+        # тэг первого ранга самый популярный
+        counts = dict(models.ProductTag.objects.annotate(n=Count("product")).values_list("slug", "n"))
+        self.assertEqual(max(counts, key=counts.get), "programming-1")
+        for order in models.Order.objects.all():
+            self.assertEqual(order.items_count, sum(order.lines.values_list("quantity", flat=True)))
+            self.assertEqual(order.total, sum(line.line_total for line in order.lines.all()))
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_generate_catalog_rerun_after_deletions(self):
+        args = ["generate_catalog", "--products", "10", "--tags", "3", "--covers", "1", "--users", "3"]
+        call_command(*args, stdout=StringIO())
+        models.Product.objects.order_by("id")[:1].get().delete()
+        models.User.objects.order_by("id")[:1].get().delete()
+        call_command(*args, stdout=StringIO())
+        self.assertEqual(models.Product.objects.count(), 19)
+        self.assertEqual(models.User.objects.count(), 5)
+
+    def test_generate_catalog_rows_do_not_depend_on_shards(self):
+        tags = [(i, name) for i, name in enumerate(generate_catalog.tag_names(5))]
+        weights = generate_catalog.zipf_cum_weights(len(tags), 1.1)
+        whole = list(generate_catalog.product_rows(0, 10, 0, tags, weights, 3))
+        split = list(generate_catalog.product_rows(0, 4, 0, tags, weights, 3))
+        split += list(generate_catalog.product_rows(4, 10, 0, tags, weights, 3))
+        self.assertEqual(whole, split)
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_generate_catalog_orders_query_count_is_constant(self):
+        counts = []
+        for orders in ("5", "50"):
+            with CaptureQueriesContext(connection) as queries:
+                call_command(
+                    "generate_catalog", "--products", "20", "--tags", "3", "--covers", "1",
+                    "--users", "2", "--baskets", orders, "--orders", orders, stdout=StringIO(),
+                )
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    @override_settings(MEDIA_ROOT=tempfile.gettempdir())
+    def test_generate_catalog_csv_imports(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "catalog.csv")
+            call_command("generate_catalog", "--products", "12", "--covers", "3", "--csv", path, stdout=StringIO())
+            self.assertFalse(models.Product.objects.exists())
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp, "images"))), ["cover-0.jpg", "cover-1.jpg", "cover-2.jpg"])
+            out = StringIO()
+            call_command("import_data", path, os.path.join(tmp, "images"), "--stream", stdout=out)
+        self.assertIn("Products processed=12 (created=12)", out.getvalue())
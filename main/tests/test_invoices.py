@@ -0,0 +1,54 @@
+import re
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+from django.core.files.storage import default_storage
+from django.test import TestCase
+from django.utils import timezone
+
+from main import invoices, models
+
+try:
+    import weasyprint
+except (ImportError, OSError):
+    # нет пакета или системных библиотек pango
+    weasyprint = None
+
+
+def normalize(html):
+    return re.sub(r"\s+", " ", html).strip()
+
+
+class TestInvoices(TestCase):
+    """Тест счетов заказов"""
+    def setUp(self):
+        user = models.User.objects.create_user("user1", "pw432joij")
+        a = models.Product.objects.create(name="A", price=Decimal("10.00"))
+        b = models.Product.objects.create(name="B", price=Decimal("12.00"))
+        address = models.Address.objects.create(
+            user=user, name="John Smith", address1="add1", address2="add2",
+            zip_code="zip", city="London", country="uk",
+        )
+        basket = models.Basket.objects.create(user=user)
+        models.BasketLine.objects.create(basket=basket, product=a, quantity=2)
+        models.BasketLine.objects.create(basket=basket, product=b, quantity=2)
+        order = basket.create_order(address, address)
+        models.Order.objects.filter(pk=order.pk).update(date_added=timezone.make_aware(datetime(2018, 7, 25, 12)))
+        self.order = models.Order.objects.get(pk=order.pk)
+
+    def test_invoice_renders_exactly_as_expected(self):
+        with open("main/fixtures/invoice_test_order.html") as f:
+            expected = f.read().replace("BT12", "BT%d" % self.order.id)
+        self.assertEqual(normalize(invoices.render_html(self.order)), normalize(expected))
+
+    @unittest.skipUnless(weasyprint, "weasyprint is not installed")
+    def test_invoices_are_content_addressed(self):
+        created, skipped = invoices.generate_invoices([self.order.id])
+        self.assertEqual((created, skipped), (1, 0))
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.invoice.name.startswith("invoices/"))
+        self.assertTrue(default_storage.exists(self.order.invoice.name))
+        self.addCleanup(default_storage.delete, self.order.invoice.name)
+
+        self.assertEqual(invoices.generate_invoices([self.order.id]), (0, 1))
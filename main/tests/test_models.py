@@ -1,7 +1,11 @@
-from django.test import TestCase
-from main import models
+from datetime import timedelta
 from decimal import Decimal
 
+from django.test import TestCase
+from django.utils import timezone
+
+from main import exceptions, models
+
 
 class TestModel(TestCase):
     """Тест модели Product"""
@@ -60,4 +64,145 @@ class TestModel(TestCase):
         self.assertEquals(order.lines.all().count(), 2)
         lines = order.lines.all()
         self.assertEquals(lines[0].product, p1)
-        self.assertEquals(lines[1].product, p2)
\ No newline at end of file
+        self.assertEquals(lines[1].product, p2)
+
+    def test_create_order_with_quantity_per_line(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"))
+        p2 = models.Product.objects.create(name="Pride and Prejudice", price=Decimal("2.00"))
+        user1 = models.User.objects.create_user("user1", "pw432joij")
+        address = models.Address.objects.create(user=user1, name="John Kimball", address1="127 Strudel road", city="London", country="uk")
+        basket = models.Basket.objects.create(user=user1)
+        models.BasketLine.objects.create(basket=basket, product=p1, quantity=50)
+        models.BasketLine.objects.create(basket=basket, product=p2, quantity=3)
+
+        # savepoint, заказ, выборка строк корзины, одна вставка строк,
+        # резервы корзины, корзина, release
+        with self.assertNumQueries(7):
+            order = basket.create_order(address, address, per_unit=False)
+        self.assertEquals(order.lines.count(), 2)
+        self.assertEquals(
+            list(order.lines.order_by("id").values_list("product", "quantity")),
+            [(p1.id, 50), (p2.id, 3)],
+        )
+        basket.refresh_from_db()
+        self.assertEquals(basket.status, models.Basket.SUBMITTED)
+
+    def test_create_order_bulk_inserts_units(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"))
+        user1 = models.User.objects.create_user("user1", "pw432joij")
+        address = models.Address.objects.create(user=user1, name="John Kimball", address1="127 Strudel road", city="London", country="uk")
+        basket = models.Basket.objects.create(user=user1)
+        models.BasketLine.objects.create(basket=basket, product=p1, quantity=50)
+
+        with self.assertNumQueries(7):
+            order = basket.create_order(address, address)
+        self.assertEquals(order.lines.filter(product=p1, quantity=1).count(), 50)
+
+    def test_basket_add_product_increments_atomically(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"))
+        basket = models.Basket.objects.create()
+        self.assertTrue(basket.add_product(p1))
+
+        # UPDATE строки и UPDATE счетчиков корзины
+        with self.assertNumQueries(2):
+            self.assertFalse(basket.add_product(p1, quantity=2))
+        self.assertEquals(basket.basketline_set.get().quantity, 3)
+        basket.refresh_from_db()
+        self.assertEquals((basket.items_count, basket.lines_count), (3, 1))
+
+    def test_stock_hold_and_allocation(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"), stock=3)
+        user1 = models.User.objects.create_user("user1", "pw432joij")
+        address = models.Address.objects.create(user=user1, name="John Kimball", address1="127 Strudel road", city="London", country="uk")
+        basket = models.Basket.objects.create(user=user1)
+        other = models.Basket.objects.create()
+        basket.add_product(p1, quantity=2)
+        with self.assertRaises(exceptions.OutOfStock):
+            other.add_product(p1, quantity=2)
+        self.assertFalse(other.basketline_set.exists())
+        p1.refresh_from_db()
+        self.assertEquals((p1.stock, p1.reserved, p1.available), (3, 2, 1))
+
+        other.add_product(p1)
+        p1.refresh_from_db()
+        self.assertFalse(p1.in_stock)
+
+        basket.create_order(address, address)
+        p1.refresh_from_db()
+        self.assertEquals((p1.stock, p1.reserved), (1, 1))
+        self.assertFalse(basket.holds.exists())
+
+    def test_checkout_fails_when_stock_sold_out(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"), stock=1)
+        user1 = models.User.objects.create_user("user1", "pw432joij")
+        address = models.Address.objects.create(user=user1, name="John Kimball", address1="127 Strudel road", city="London", country="uk")
+        basket = models.Basket.objects.create(user=user1)
+        # строка без резерва, например после истечения резерва
+        models.BasketLine.objects.create(basket=basket, product=p1, quantity=2)
+        with self.assertRaises(exceptions.OutOfStock):
+            basket.create_order(address, address)
+        self.assertFalse(models.Order.objects.exists())
+        p1.refresh_from_db()
+        self.assertEquals(p1.stock, 1)
+
+    def test_sweep_expired_holds(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"), stock=5)
+        basket = models.Basket.objects.create()
+        basket.add_product(p1, quantity=2)
+        models.StockHold.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEquals(models.StockHold.objects.sweep_expired(), 1)
+        p1.refresh_from_db()
+        self.assertEquals(p1.reserved, 0)
+
+        basket.add_product(p1)
+        basket.delete()
+        p1.refresh_from_db()
+        self.assertEquals(p1.reserved, 0)
+
+    def test_product_save_keeps_reserved(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"), stock=5)
+        stale = models.Product.objects.get(pk=p1.pk)
+        models.Basket.objects.create().add_product(p1)
+        stale.price = Decimal("11.00")
+        stale.save()
+        p1.refresh_from_db()
+        self.assertEquals((p1.price, p1.reserved), (Decimal("11.00"), 1))
+
+    def test_product_slug_is_ascii_and_unique(self):
+        p1 = models.Product.objects.create(name="Война и мир", price=Decimal("10.00"))
+        p2 = models.Product.objects.create(name="Война и мир", price=Decimal("12.00"))
+        p3 = models.Product.objects.create(name="战争与和平", price=Decimal("12.00"))
+        self.assertEquals((p1.slug, p2.slug, p3.slug), ("voina-i-mir", "voina-i-mir-2", "product"))
+        p1.save()
+        self.assertEquals(p1.slug, "voina-i-mir")
+
+    def test_order_summary_is_maintained(self):
+        p1 = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"))
+        p2 = models.Product.objects.create(name="Pride and Prejudice", price=Decimal("2.00"))
+        user1 = models.User.objects.create_user("user1", "pw432joij")
+        address = models.Address.objects.create(user=user1, name="John Kimball", address1="127 Strudel road", city="London", country="uk")
+        basket = models.Basket.objects.create(user=user1)
+        models.BasketLine.objects.create(basket=basket, product=p1, quantity=3)
+        models.BasketLine.objects.create(basket=basket, product=p2, quantity=1)
+        order = basket.create_order(address, address)
+        order.refresh_from_db()
+        self.assertEquals(
+            (order.lines_count, order.items_count, order.products_count, order.new_count),
+            (4, 4, 2, 4),
+        )
+        self.assertEquals(order.total, Decimal("32.00"))
+        p1.price = Decimal("99.00")
+        p1.save()
+        order.update_summary()
+        self.assertEquals(order.total, Decimal("32.00"))
+
+        self.assertEquals(order.lines.filter(product=p1).set_status(models.OrderLine.SENT), 3)
+        line = order.lines.get(product=p2)
+        line.status = models.OrderLine.CANCELLED
+        line.save()
+        order.refresh_from_db()
+        self.assertEquals((order.new_count, order.sent_count, order.cancelled_count), (0, 3, 1))
+
+        line.delete()
+        order.refresh_from_db()
+        self.assertEquals((order.items_count, order.products_count, order.cancelled_count), (3, 1, 0))
@@ -0,0 +1,67 @@
+import os
+import tempfile
+from unittest.mock import patch
+from django.test import TestCase
+from main import search
+
+
+class TestSearchIndex(TestCase):
+    """Тест поискового индекса"""
+    def setUp(self):
+        self.index = search.SearchIndex()
+        self.index.add(1, "Программирование на Python", "<p>Учебник для начинающих</p>", ["Программирование"])
+        self.index.add(2, "The cathedral and the bazaar", "<p>A book about open source</p>", ["Open source"])
+        self.index.add(3, "Ёжик в тумане", "Сказка", ["Детям"])
+        self.index.add(4, "Python cookbook", "Recipes for programming", [])
+
+    def test_ranks_name_matches_first(self):
+        self.assertEqual(self.index.search("python"), [1, 4])
+        self.assertEqual(self.index.search("source"), [2])
+
+    def test_prefix_and_cyrillic_matching(self):
+        self.assertEqual(self.index.search("програм"), [1])
+        self.assertEqual(self.index.search("программы"), [1])
+        self.assertEqual(self.index.search("ежик"), [3])
+        self.assertEqual(self.index.search("учебник питон"), [])
+        self.assertEqual(self.index.search("cathedral baz"), [2])
+
+    def test_html_is_stripped_and_remove_works(self):
+        self.assertEqual(self.index.search("p"), [])
+        self.index.remove(1)
+        self.assertEqual(self.index.search("python"), [4])
+        self.assertNotIn("учебник", self.index.postings)
+
+
+class TestIndexFile(TestCase):
+    """Тест файла индекса, общего для нескольких процессов"""
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "search.idx")
+        patcher = patch("main.search.INDEX_PATH", self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(search.set_index, search.SearchIndex())
+        search.set_index(None)
+
+    def test_missing_index_is_not_built_from_database(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(search.get_index().search("python"), [])
+
+    def test_reload_keeps_unsaved_changes(self):
+        index = search.SearchIndex()
+        index.add(1, "Python cookbook", "", [])
+        index.add(2, "Python crash course", "", [])
+        search.write_index(index)
+        search.remove_product(1)
+
+        # другой процесс записал файл со своим изменением
+        other = search.SearchIndex.load(self.path)
+        other.add(3, "Fluent Python", "", [])
+        other.save(self.path)
+        mtime = os.path.getmtime(self.path) + 1
+        os.utime(self.path, (mtime, mtime))
+
+        self.assertEqual(search.get_index().search("python"), [2, 3])
+        search.save_index(force=True)
+        self.assertEqual(search.SearchIndex.load(self.path).search("python"), [2, 3])
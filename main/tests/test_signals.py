@@ -1,5 +1,5 @@
 from django.test import TestCase
-from main import models
+from main import models, renditions
 from django.core.files.images import ImageFile
 from decimal import Decimal
 
@@ -24,6 +24,19 @@ class TestSignal(TestCase):
 
         self.assertGreaterEqual(len(cm.output), 1)
         image.refresh_from_db()
+        self.assertFalse(image.thumbnail)
+        self.assertEqual(image.rendition_jobs.filter(status=models.RenditionJob.NEW).count(), 1)
+
+        self.assertEqual(renditions.process_pending(), 1)
+        image.refresh_from_db()
+        self.assertTrue(image.thumbnail)
+        self.assertEqual(len(image.image_hash), 64)
+        self.assertEqual(image.rendition_jobs.get().status, models.RenditionJob.DONE)
+        expected = len(renditions.RENDITIONS) * len(renditions.available_formats())
+        self.assertTrue(0 < image.renditions.count() <= expected)
+        for rendition in image.renditions.filter(format="jpeg"):
+            self.assertLessEqual(max(rendition.width, rendition.height), max(renditions.RENDITIONS[rendition.name]))
+            self.assertIn("%s %dw" % (rendition.image.url, rendition.width), image.srcset())
 
         with open(
             "main/fixtures/the-cathedral-the-bazaar.thumb.jpg",
@@ -32,6 +45,57 @@ class TestSignal(TestCase):
             expected_content = f.read()
             # assert image.thumbnail.read() == expected_content
 
+        for rendition in image.renditions.all():
+            rendition.image.delete(save=False)
         image.thumbnail.delete(save=False)
         image.image.delete(save=False)
 
+    def test_thumbnails_are_skipped_for_unchanged_image(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            price=Decimal("10.00"),
+        )
+        with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+            image = models.ProductImage(product=product, image=ImageFile(f, name="tctb.jpg"))
+            image.save()
+        renditions.process_pending()
+        image.refresh_from_db()
+
+        image.save()
+        self.assertFalse(image.rendition_jobs.filter(status=models.RenditionJob.NEW).exists())
+
+        for rendition in image.renditions.all():
+            rendition.image.delete(save=False)
+        image.thumbnail.delete(save=False)
+        image.image.delete(save=False)
+
+    def test_renditions_use_single_reduced_decode(self):
+        with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+            data = f.read()
+        thumbnail, result = renditions.render_renditions(data, {"list": (300, 300), "detail": (600, 600)}, ("jpeg",))
+        self.assertEqual([(name, fmt) for name, fmt, w, h, content in result], [("detail", "jpeg"), ("list", "jpeg")])
+        for name, fmt, width, height, content in result:
+            self.assertLessEqual(max(width, height), 600 if name == "detail" else 300)
+        self.assertTrue(thumbnail.startswith(b"\xff\xd8"))
+
+    def test_missing_source_fails_only_its_job(self):
+        product = models.Product.objects.create(name="The cathedral and the bazaar", price=Decimal("10.00"))
+        images = []
+        for name in ("tctb.jpg", "missing.jpg"):
+            with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+                image = models.ProductImage(product=product, image=ImageFile(f, name=name))
+                image.save()
+            images.append(image)
+        images[1].image.delete(save=False)
+
+        with self.assertLogs("main.renditions", level="ERROR"):
+            self.assertEqual(renditions.process_pending(), 2)
+        self.assertEqual(images[0].rendition_jobs.get().status, models.RenditionJob.DONE)
+        job = images[1].rendition_jobs.get()
+        self.assertEqual((job.status, job.attempts), (models.RenditionJob.NEW, 1))
+
+        images[0].refresh_from_db()
+        for rendition in images[0].renditions.all():
+            rendition.image.delete(save=False)
+        images[0].thumbnail.delete(save=False)
+        images[0].image.delete(save=False)
@@ -1,10 +1,19 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from main import forms
 from decimal import Decimal
 from main import models
+from main import caching
+from main import metrics
+from main import search
+from io import StringIO
 from unittest.mock import patch
 from django.contrib import auth
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 
 class TestPage(TestCase):
@@ -51,6 +60,10 @@ class TestPage(TestCase):
         product_list = (models.Product.objects.active().filter(tags__slug="opensource").order_by("name"))
         self.assertEqual(list(response.context["object_list"]), list(product_list))
 
+        response = self.client.get(reverse("products", kwargs={"tag": "no-such-tag"}))
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(cache.get(caching.version_key("no-such-tag")))
+
     def test_user_signup_page_loads_correctly(self):
         response = self.client.get(reverse("signup"))
 
@@ -116,3 +129,302 @@ class TestPage(TestCase):
         basket = models.Basket.objects.get(user=user1)
         self.assertEquals(basket.count(), 3)
 
+
+    def test_basket_middleware_ignores_stale_basket_id(self):
+        session = self.client.session
+        session["basket_id"] = 999
+        session.save()
+        response = self.client.get(reverse("about_us"))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("basket_id", self.client.session)
+
+    def test_basket_middleware_serves_basket_from_cache(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        self.client.get(reverse("about_us"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("about_us"))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('FROM "main_basket"' in q["sql"] for q in queries.captured_queries))
+
+    def test_basket_cache_is_invalidated_on_add(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        basket_id = self.client.session["basket_id"]
+        self.client.get(reverse("about_us"))
+        self.assertIsNotNone(cache.get(models.Basket.cache_key(basket_id)))
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        self.assertIsNone(cache.get(models.Basket.cache_key(basket_id)))
+
+    def test_basket_counts_are_maintained(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        w = models.Product.objects.create(name="Microsoft Windows guide", slug="microsoft-windows-guide", price=Decimal("12.00"))
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        self.client.get(reverse("add_to_basket"), {"product_id": w.id})
+        basket = models.Basket.objects.get(id=self.client.session["basket_id"])
+        self.assertEquals((basket.items_count, basket.lines_count), (3, 2))
+
+        cb_line = basket.basketline_set.get(product=cb)
+        w_line = basket.basketline_set.get(product=w)
+        self.client.post(reverse("basket"), {
+            "basketline_set-TOTAL_FORMS": "2",
+            "basketline_set-INITIAL_FORMS": "2",
+            "basketline_set-0-id": cb_line.id,
+            "basketline_set-0-quantity": "5",
+            "basketline_set-1-id": w_line.id,
+            "basketline_set-1-quantity": "1",
+            "basketline_set-1-DELETE": "on",
+        })
+        basket.refresh_from_db()
+        self.assertEquals((basket.items_count, basket.lines_count), (5, 1))
+        self.assertEquals(basket.count(), 5)
+
+    def test_basket_admin_changelist_query_count_is_constant(self):
+        admin_user = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        self.client.force_login(admin_user)
+
+        def changelist_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("admin:main_basket_changelist"))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        basket = models.Basket.objects.create(user=admin_user)
+        models.BasketLine.objects.create(basket=basket, product=cb)
+        expected = changelist_queries()
+        for i in range(5):
+            basket = models.Basket.objects.create(user=admin_user)
+            models.BasketLine.objects.create(basket=basket, product=cb, quantity=2)
+        self.assertEqual(changelist_queries(), expected)
+
+    def test_search_page_returns_ranked_products(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"), description="<b>Open source</b> essays")
+        models.Product.objects.create(name="Microsoft Windows guide", slug="microsoft-windows-guide", price=Decimal("12.00"))
+        models.Product.objects.create(name="Open source hidden", slug="open-source-hidden", price=Decimal("12.00"), active=False)
+        search.set_index(search.build_index())
+        response = self.client.get(reverse("search"), {"q": "open sour"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "main/search.html")
+        self.assertEqual(list(response.context["object_list"]), [cb])
+
+    def test_products_page_keyset_pagination(self):
+        for i in range(10):
+            models.Product.objects.create(name="Book %02d" % (i // 2), slug="book-%d" % i, price=Decimal("1.00"))
+        expected = list(models.Product.objects.active().order_by("name", "id"))
+
+        response = self.client.get(reverse("products", kwargs={"tag": "all"}))
+        self.assertEqual(list(response.context["object_list"]), expected[:4])
+        page = response.context["page_obj"]
+        self.assertFalse(page.has_previous())
+
+        response = self.client.get(reverse("products", kwargs={"tag": "all"}), {"cursor": page.next_cursor})
+        self.assertEqual(list(response.context["object_list"]), expected[4:8])
+        page = response.context["page_obj"]
+
+        response = self.client.get(reverse("products", kwargs={"tag": "all"}), {"cursor": page.next_cursor})
+        self.assertEqual(list(response.context["object_list"]), expected[8:])
+        self.assertFalse(response.context["page_obj"].has_next())
+
+        response = self.client.get(reverse("products", kwargs={"tag": "all"}), {"cursor": page.previous_cursor})
+        self.assertEqual(list(response.context["object_list"]), expected[:4])
+        self.assertFalse(response.context["page_obj"].has_previous())
+
+        response = self.client.get(reverse("products", kwargs={"tag": "all"}), {"cursor": "bogus"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_products_page_is_served_from_cache(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        cb.tags.create(name="Open source", slug="opensource")
+        w = models.Product.objects.create(name="Microsoft Windows guide", slug="microsoft-windows-guide", price=Decimal("12.00"))
+        w.tags.create(name="Windows", slug="windows")
+        self.client.get(reverse("products", kwargs={"tag": "opensource"}))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("products", kwargs={"tag": "opensource"}))
+        self.assertContains(response, "The cathedral and the bazaar")
+        self.assertFalse(any("main_product" in q["sql"] for q in queries.captured_queries))
+
+        opensource_version = caching.get_version("opensource")
+        w.name = "Windows guide"
+        w.save()
+        self.assertEqual(caching.get_version("opensource"), opensource_version)
+
+        cb.name = "The cathedral and the bazaar, 2nd edition"
+        cb.save()
+        self.assertNotEqual(caching.get_version("opensource"), opensource_version)
+        response = self.client.get(reverse("products", kwargs={"tag": "opensource"}))
+        self.assertContains(response, "2nd edition")
+
+    def test_product_page_is_conditional_and_cached(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        cb.tags.create(name="Open source", slug="opensource")
+        url = reverse("product", kwargs={"slug": "cathedral-bazaar"})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "main/product_detail.html")
+        self.assertContains(response, "Open source")
+        self.assertEqual(response.context["images"], [])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertFalse(any("main_productimage" in q["sql"] for q in queries.captured_queries))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        cb.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse("product", kwargs={"slug": "missing"})).status_code, 404)
+
+    def test_login_merge_sums_duplicate_products(self):
+        user1 = models.User.objects.create_user("user1@a.com", "pw432joij")
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        w = models.Product.objects.create(name="Microsoft Windows guide", slug="microsoft-windows-guide", price=Decimal("12.00"))
+        basket = models.Basket.objects.create(user=user1)
+        models.BasketLine.objects.create(basket=basket, product=cb, quantity=2)
+        other = models.Basket.objects.create(user=user1)
+        models.BasketLine.objects.create(basket=other, product=w, quantity=1)
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        self.client.get(reverse("add_to_basket"), {"product_id": w.id})
+        self.client.post(reverse("login"), {"email": "user1@a.com", "password": "pw432joij"})
+
+        basket = models.Basket.objects.get(user=user1)
+        self.assertEqual(self.client.session["basket_id"], basket.id)
+        self.assertEqual(
+            sorted(basket.basketline_set.values_list("product_id", "quantity")),
+            [(cb.id, 3), (w.id, 2)],
+        )
+        self.assertEqual((basket.items_count, basket.lines_count), (5, 2))
+        self.assertEqual(models.Basket.objects.count(), 1)
+
+    def test_add_to_basket_json_returns_counts(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        response = self.client.get(reverse("add_to_basket_json"), {"product_id": cb.id})
+        self.assertEqual(response.status_code, 405)
+        self.client.post(reverse("add_to_basket_json"), {"product_id": cb.id})
+        response = self.client.post(reverse("add_to_basket_json"), {"product_id": cb.id})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data["items_count"], data["lines_count"]), (2, 1))
+        self.assertEqual(data["basket_id"], self.client.session["basket_id"])
+        self.assertEqual(models.BasketLine.objects.get(basket_id=data["basket_id"]).quantity, 2)
+
+    def test_add_to_basket_out_of_stock(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"), stock=1)
+        self.client.post(reverse("add_to_basket_json"), {"product_id": cb.id})
+        response = self.client.post(reverse("add_to_basket_json"), {"product_id": cb.id})
+        self.assertEqual(response.status_code, 409)
+        url = reverse("product", kwargs={"slug": cb.slug})
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(reverse("add_to_basket"), {"product_id": cb.id}, follow=True, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Товара нет в наличии")
+        self.assertEqual(models.BasketLine.objects.get().quantity, 1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_login_merge_keeps_stock_holds(self):
+        user1 = models.User.objects.create_user("user1@a.com", "pw432joij")
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"), stock=3)
+        basket = models.Basket.objects.create(user=user1)
+        basket.add_product(cb)
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        self.client.post(reverse("login"), {"email": "user1@a.com", "password": "pw432joij"})
+
+        cb.refresh_from_db()
+        self.assertEqual(cb.reserved, 2)
+        self.assertEqual(list(models.StockHold.objects.values_list("basket_id", "quantity")), [(basket.id, 2)])
+
+    def test_basket_formset_adjusts_stock_holds(self):
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"), stock=3)
+        self.client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        line = models.BasketLine.objects.get()
+        data = {
+            "basketline_set-TOTAL_FORMS": 1,
+            "basketline_set-INITIAL_FORMS": 1,
+            "basketline_set-0-id": line.id,
+            "basketline_set-0-basket": line.basket_id,
+        }
+        self.client.post(reverse("basket"), dict(data, **{"basketline_set-0-quantity": 3}))
+        cb.refresh_from_db()
+        self.assertEqual((cb.reserved, models.StockHold.objects.get().quantity), (3, 3))
+
+        models.Product.objects.filter(pk=cb.pk).update(stock=4, reserved=4)
+        response = self.client.post(reverse("basket"), dict(data, **{"basketline_set-0-quantity": 4}))
+        self.assertContains(response, "недостаточно на складе")
+        self.assertEqual(models.BasketLine.objects.get().quantity, 3)
+
+        self.client.post(reverse("basket"), dict(data, **{"basketline_set-0-quantity": 1}))
+        cb.refresh_from_db()
+        self.assertEqual((cb.reserved, models.StockHold.objects.get().quantity), (2, 1))
+
+        self.client.post(reverse("basket"), dict(data, **{"basketline_set-0-quantity": 1, "basketline_set-0-DELETE": "on"}))
+        cb.refresh_from_db()
+        self.assertEqual(cb.reserved, 1)
+        self.assertFalse(models.StockHold.objects.exists())
+
+    def test_order_admin_change_page_groups_lines(self):
+        admin_user = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        cb = models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        address = models.Address.objects.create(user=admin_user, name="John Kimball", address1="127 Strudel road", city="London", country="uk")
+        basket = models.Basket.objects.create(user=admin_user)
+        models.BasketLine.objects.create(basket=basket, product=cb, quantity=300)
+        order = basket.create_order(address, address)
+        self.client.force_login(admin_user)
+
+        response = self.client.get(reverse("admin:main_order_change", args=(order.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "<td>The cathedral and the bazaar</td><td>New</td><td>300</td>", html=False)
+        self.assertNotContains(response, "lines-TOTAL_FORMS")
+        response = self.client.get(reverse("admin:main_order_changelist"))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(PROFILING_ENABLED=True, PROFILING_LATENCY_BUDGET=0)
+    def test_profiling_middleware_exports_metrics(self):
+        metrics.registry.reset()
+        models.Product.objects.create(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 302)
+
+        with self.assertLogs("main.middlewares", "WARNING") as logs:
+            self.client.get(reverse("products", kwargs={"tag": "all"}))
+        self.assertIn("Медленный запрос GET /products/all/ (products)", logs.output[0])
+
+        admin_user = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertContains(response, 'booktime_request_duration_seconds_count{view="products"} 1')
+        self.assertContains(response, 'booktime_cache_misses_total{view="products"} 1')
+        self.assertContains(response, 'booktime_db_queries_bucket{view="products",le="+Inf"} 1')
+
+    def test_contact_us_queues_email(self):
+        response = self.client.post(reverse("contact_us"), {"name": "Дмитрий П", "message": "Привет"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(models.OutgoingEmail.objects.get().to, ["customerservice@booktime.domain"])
+        call_command("send_queued_mail", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    async def test_async_basket_and_catalog_views(self):
+        response = await self.async_client.get(reverse("basket_summary"))
+        self.assertEqual(response.json(), {"basket_id": None, "items_count": 0, "lines_count": 0})
+
+        cb = await models.Product.objects.acreate(name="The cathedral and the bazaar", slug="cathedral-bazaar", price=Decimal("10.00"))
+        response = await self.async_client.post(reverse("add_to_basket_json"), {"product_id": cb.id})
+        self.assertEqual(response.status_code, 200)
+        await self.async_client.get(reverse("add_to_basket"), {"product_id": cb.id})
+        response = await self.async_client.get(reverse("basket_summary"))
+        data = response.json()
+        self.assertEqual((data["items_count"], data["lines_count"]), (2, 1))
+
+        response = await self.async_client.get(reverse("products", kwargs={"tag": "all"}))
+        self.assertContains(response, "The cathedral and the bazaar")
+        url = reverse("product", kwargs={"slug": "cathedral-bazaar"})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get(url, headers={"if-none-match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
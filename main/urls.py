@@ -1,10 +1,9 @@
 from django.contrib.auth import views as auth_views
 from django.urls import path
 from django.views.generic import TemplateView
-from django.views.generic.detail import DetailView
 
+from main import api
 from main import forms
-from main import models
 from main import views
 
 
@@ -14,14 +13,23 @@ urlpatterns = [
     path("order/address_select/", views.AddressSelectionView.as_view(), name="address_select"),
     path('basket/', views.manage_basket, name="basket"),
     path("add_to_basket/", views.add_to_basket, name="add_to_basket"),
+    path("add_to_basket.json", views.add_to_basket_json, name="add_to_basket_json"),
+    path("basket/summary.json", views.basket_summary, name="basket_summary"),
+    path("metrics/", views.metrics_view, name="metrics"),
     path("address/", views.AddressListView.as_view(), name="address_list"),
     path("address/create/", views.AddressCreateView.as_view(), name="address_create"),
     path("address/<int:pk>/", views.AddressUpdateView.as_view(), name="address_update"),
     path("address/<int:pk>/delete/", views.AddressDeleteView.as_view(), name="address_delete"),
     path("login/", auth_views.LoginView.as_view(template_name="login.html", form_class=forms.AuthenticationForm,), name="login"),
     path('signup/', views.SignupView.as_view(), name="signup"),
-    path("product/<slug:slug>/", DetailView.as_view(model=models.Product), name="product"),
+    path("product/<slug:slug>/", views.ProductDetailView.as_view(), name="product"),
     path("products/<slug:tag>/", views.ProductListView.as_view(), name="products"),
+    path("search/", views.SearchView.as_view(), name="search"),
+    path("api/products/", api.product_list, name="api_product_list"),
+    path("api/products/<slug:slug>/", api.product_detail, name="api_product_detail"),
+    path("api/products/<slug:slug>/images/", api.product_images, name="api_product_images"),
+    path("api/tags/", api.tag_list, name="api_tag_list"),
+    path("api/export/products.jsonl", api.product_export, name="api_product_export"),
     path("contact-us/", views.ContactUsView.as_view(), name="contact_us"),
     path("about-us/", TemplateView.as_view(template_name="about_us.html"), name="about_us"),
     path("", TemplateView.as_view(template_name="home.html"), name="home"),
@@ -1,16 +1,33 @@
+import hashlib
 import logging
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponseRedirect
-from django.shortcuts import get_object_or_404, render
+from django.core.paginator import InvalidPage
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
+from django.shortcuts import aget_object_or_404, render
+from django.template.loader import render_to_string
 from django.urls import reverse_lazy, reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import require_GET, require_POST
+from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView, CreateView, UpdateView, DeleteView
 from django.views.generic.list import ListView
 
+from main import caching
+from main import exceptions
 from main import forms
+from main import metrics
 from main import models
+from main import search
+from main.pagination import KeysetPaginator
 
 logger = logging.getLogger(__name__)
 
@@ -27,20 +44,117 @@ class ContactUsView(FormView):
 
 
 class ProductListView(ListView):
-    """Страница с товарами"""
+    """Страница с товарами, async-view: под ASGI без перехода в поток"""
     template_name = "main/product_list.html"
+    fragment_template_name = "main/product_list_fragment.html"
     paginate_by = 4
-
-    def get_queryset(self):
-        tag = self.kwargs['tag']
+    ordering = ("name", "id")
+
+    async def get(self, request, *args, **kwargs):
+        tag = self.kwargs["tag"]
+        cursor = request.GET.get("cursor", "")
+        version = await caching.aget_version(tag, create=False)
+        if version is None:
+            # версия без срока хранения заводится только для существующих тэгов
+            if tag != caching.ALL_TAGS and not await models.ProductTag.objects.filter(slug=tag).aexists():
+                raise Http404("Тэг не найден")
+            version = await caching.aget_version(tag)
+        key = "products:%s:%s:%s" % (tag, version, hashlib.md5(cursor.encode()).hexdigest())
+        timeout = getattr(settings, "PRODUCT_LIST_CACHE_TIMEOUT", 60 * 60)
+        fragment = await caching.aget_or_build(key, self.render_fragment, timeout)
+        return self.render_to_response({"fragment": mark_safe(fragment), "tag": tag})
+
+    def get_template_names(self):
+        return [self.template_name]
+
+    async def render_fragment(self):
+        tag = self.kwargs["tag"]
         self.tag = None
         if tag != "all":
-            self.tag = get_object_or_404(models.ProductTag, slug=tag)
+            self.tag = await aget_object_or_404(models.ProductTag, slug=tag)
+        paginator = KeysetPaginator(self.get_queryset(), self.paginate_by, ordering=self.ordering)
+        try:
+            page = await paginator.apage(self.request.GET.get("cursor"))
+        except InvalidPage:
+            raise Http404("Неверный курсор страницы")
+        self.object_list = page.object_list
+        context = {
+            "paginator": paginator,
+            "page_obj": page,
+            "is_paginated": page.has_other_pages(),
+            "object_list": page.object_list,
+            "product_list": page.object_list,
+            "view": self,
+        }
+        if getattr(settings, "PRODUCT_LIST_APPROXIMATE_TOTAL", False):
+            context["approximate_total"] = await sync_to_async(paginator.approximate_count)()
+        return render_to_string(self.fragment_template_name, context, request=self.request)
+
+    def get_queryset(self):
+        """Товары тэга self.tag, без обращения к базе до выборки страницы"""
         if self.tag:
             products = models.Product.objects.active().filter(tags=self.tag)
         else:
             products = models.Product.objects.active()
-        return products.order_by("name")
+        return products.order_by(*self.ordering)
+
+
+async def product_etag(request, state):
+    """Версия страницы товара: дата изменения, наличие и счетчик корзины"""
+    date_updated, stock, reserved = state
+    in_stock = stock is None or stock > reserved
+    basket = await request.abasket()
+    items = basket.count() if basket else 0
+    return "%s-%d-%d" % (date_updated.timestamp(), in_stock, items)
+
+
+class ProductDetailView(DetailView):
+    """Страница товара, условный GET по ETag и Last-Modified"""
+    model = models.Product
+
+    def get_queryset(self):
+        return models.Product.objects.prefetch_related("tags")
+
+    async def get(self, request, *args, **kwargs):
+        slug = self.kwargs["slug"]
+        state = await models.Product.objects.filter(slug=slug).values_list(
+            "date_updated", "stock", "reserved"
+        ).afirst()
+        if state is None:
+            raise Http404("Товар не найден")
+        etag = quote_etag(await product_etag(request, state))
+        last_modified = int(state[0].timestamp())
+        # непоказанные сообщения (например "Товара нет в наличии" после
+        # add_to_basket) не попадают в ETag, поэтому 304 для них не отдается
+        pending = await sync_to_async(len)(messages.get_messages(request))
+        response = None if pending else get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            try:
+                self.object = await self.get_queryset().aget(slug=slug)
+            except models.Product.DoesNotExist:
+                raise Http404("Товар не найден")
+            context = self.get_context_data(object=self.object, images=await self.object.aimage_manifest())
+            response = self.render_to_response(context)
+        response.headers["ETag"] = etag
+        response.headers["Last-Modified"] = http_date(last_modified)
+        return response
+
+
+class SearchView(ListView):
+    """Поиск товаров"""
+    template_name = "main/search.html"
+    paginate_by = 10
+
+    def get_queryset(self):
+        self.query = self.request.GET.get("q", "").strip()
+        return search.get_index().search(self.query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        products = models.Product.objects.in_bulk(context["object_list"])
+        context["object_list"] = [products[pk] for pk in context["object_list"] if pk in products]
+        context["query"] = self.query
+        return context
 
 
 class SignupView(FormView):
@@ -54,7 +168,10 @@ class SignupView(FormView):
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        form.save()
+        with transaction.atomic():
+            form.save()
+            # письмо фиксируется в очереди вместе с пользователем
+            form.send_mail()
 
         email = form.cleaned_data.get("email")
         raw_password = form.cleaned_data.get("password1")
@@ -62,7 +179,6 @@ class SignupView(FormView):
 
         user = authenticate(email=email, password=raw_password)
         login(self.request, user)
-        form.send_mail()
         messages.info(self.request, "Вы успешно зарегистрировались.")
         return response
 
@@ -108,25 +224,59 @@ class AddressDeleteView(LoginRequiredMixin, DeleteView):
         return self.model.objects.filter(user=self.request.user)
 
 
-def add_to_basket(request):
+async def _add_product_to_basket(request):
+    product_id = request.GET.get("product_id") or request.POST.get("product_id")
+    product = await aget_object_or_404(models.Product, pk=product_id)
+    basket = await request.abasket()
+    if not basket:
+        user = await request.auser()
+        basket = await models.Basket.objects.acreate(user=user if user.is_authenticated else None)
+        await request.session.aset("basket_id", basket.id)
+    # блокировки и точки сохранения работают только в синхронном коде
+    await sync_to_async(basket.add_product)(product)
+    return product, basket
+
+
+async def add_to_basket(request):
     """Добавление в корзину"""
-    product = get_object_or_404(models.Product, pk=request.GET.get("product_id"))
-    basket = request.basket
-    if not request.basket:
-        if request.user.is_authenticated:
-            user = request.user
-        else:
-            user = None
-        basket = models.Basket.objects.create(user=user)
-        request.session["basket_id"] = basket.id
-    basketline, created = models.BasketLine.objects.get_or_create(basket=basket, product=product)
-
-    if not created:
-        basketline.quantity += 1
-        basketline.save()
+    try:
+        product, basket = await _add_product_to_basket(request)
+    except exceptions.OutOfStock as e:
+        messages.error(request, "Товара нет в наличии")
+        product = e.product
     return HttpResponseRedirect(reverse("product", args=(product.slug,)))
 
 
+@require_POST
+async def add_to_basket_json(request):
+    """Добавление в корзину без перезагрузки страницы"""
+    try:
+        product, basket = await _add_product_to_basket(request)
+    except exceptions.OutOfStock as e:
+        return JsonResponse({"product_id": e.product.id, "error": "out_of_stock"}, status=409)
+    # счетчики могли измениться параллельными запросами
+    await basket.arefresh_from_db(fields=["items_count", "lines_count"])
+    return JsonResponse({
+        "product_id": product.id,
+        "basket_id": basket.id,
+        "items_count": basket.items_count,
+        "lines_count": basket.lines_count,
+    })
+
+
+@require_GET
+async def basket_summary(request):
+    """Счетчики корзины для шапки сайта, из кэша корзины"""
+    basket = await request.abasket()
+    if not basket:
+        return JsonResponse({"basket_id": None, "items_count": 0, "lines_count": 0})
+    return JsonResponse({
+        "basket_id": basket.id,
+        "items_count": basket.items_count,
+        "lines_count": basket.lines_count,
+    })
+
+
 def manage_basket(request):
     """Страница с корзиной"""
     if not request.basket:
@@ -136,7 +286,10 @@ def manage_basket(request):
         formset = forms.BasketLineFormSet(request.POST, instance=request.basket)
 
         if formset.is_valid():
-            formset.save()
+            try:
+                formset.save()
+            except exceptions.OutOfStock as e:
+                messages.error(request, "Товара «%s» недостаточно на складе" % e.product.name)
     else:
         formset = forms.BasketLineFormSet(instance=request.basket)
 
@@ -156,11 +309,29 @@ class AddressSelectionView(LoginRequiredMixin, FormView):
         return kwargs
 
     def form_valid(self, form):
-        print(self.request.user)
-        del self.request.session['basket_id']
         basket = self.request.basket
-        basket.create_order(
-            form.cleaned_data['billing_address'],
-            form.cleaned_data['shipping_address']
-        )
-        return super().form_valid(form)
\ No newline at end of file
+        try:
+            with transaction.atomic():
+                order = basket.create_order(
+                    form.cleaned_data['billing_address'],
+                    form.cleaned_data['shipping_address'],
+                    per_unit=getattr(settings, "ORDER_LINES_PER_UNIT", True),
+                )
+                models.OutgoingEmail.objects.enqueue(
+                    "Заказ BT%d оформлен" % order.id,
+                    "Спасибо за заказ! Сумма заказа: %s" % order.total,
+                    "site@booktime.domain",
+                    [self.request.user.email],
+                    dedupe_key="order:%d" % order.id,
+                )
+        except exceptions.OutOfStock as e:
+            messages.error(self.request, "Товара «%s» недостаточно на складе" % e.product.name)
+            return HttpResponseRedirect(reverse("basket"))
+        del self.request.session['basket_id']
+        return super().form_valid(form)
+
+
+@staff_member_required
+def metrics_view(request):
+    """Метрики процесса в формате Prometheus"""
+    return HttpResponse(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")